@@ -1,19 +1,237 @@
-from utils.avif_image_utils import load_image_np, linear_to_srgb
+from utils.avif_image_utils import load_image_np, load_images_np, load_mask_np, write_image_into, srgb8_to_linear_lut, linear_to_srgb, get_resized_size
+from utils.dataset_manifest import read_image_size
+from olat_relight.relight_cache import RelightCache
 from tqdm import tqdm
 import numpy as np
-import cv2, os
+import cv2, os, tempfile
+import scipy.sparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Size (in bytes) of the float32 band of OLAT data processed at once during relighting
+RELIGHT_BAND_BYTES = 32 * 1024 * 1024
+CONTRACT_BAND_BYTES = 2 * 1024 * 1024 # Bands of contract_olats stay in the CPU cache while they are multiplied
+CONTRACT_STACKED_MAX_ENVS = 8 # Up to this many lightings, all channels are contracted by one matrix product
+
+
+def contract_olats(olat_tensor, light_bases, out=None, band_bytes=CONTRACT_BAND_BYTES, lut=None, accumulate=False, light_index=None):
+    """ Computes the weighted sum over lights of an OLAT tensor without building a (L, ..., 3) temporary.
+    The OLATs are processed in bands of pixels small enough to stay in the CPU cache, so the OLAT data is read
+    from memory only once. A band is contracted by float32 BLAS matrix products: for few lightings a single
+    product with the weights of all channels stacked (whose cross-channel terms are discarded), otherwise one
+    product per channel.
+
+    Parameters
+    ----------
+    olat_tensor : np.array
+        (L, ..., C) OLAT tensor, e.g. (L, H, W, 3)
+    light_bases : np.array
+        (L, C) weights for a single lighting or (L, E, C) weights for E lightings
+    out : np.array, optional
+        preallocated float32 output of shape (..., C) or (E, ..., C), default: None (allocate)
+    band_bytes : int, optional
+        size of the float32 OLAT band processed at once, default: CONTRACT_BAND_BYTES
+    lut : np.array, optional
+        (256,) float32 table decoding a uint8 OLAT tensor, default: None (OLAT tensor holds float values)
+    accumulate : bool, optional
+        add the result to the given out instead of overwriting it, default: False
+    light_index : np.array, optional
+        (K,) indices of the OLATs to contract, light_bases then holds (K, C) or (K, E, C) weights for these OLATs only,
+        default: None (all OLATs)
+
+    Returns
+    -------
+    out : np.array
+        float32 relit image(s) of shape (..., C) for (L, C) bases or (E, ..., C) for (L, E, C) bases
+    """
+
+    N_LIGHTS, N_CHANNELS = olat_tensor.shape[0] if light_index is None else len(light_index), olat_tensor.shape[-1]
+    pixel_shape = olat_tensor.shape[1:-1]
+
+    single = light_bases.ndim == 2
+    weights = np.asarray(light_bases, dtype=np.float32).reshape(N_LIGHTS, -1, N_CHANNELS)
+    N_ENVS = weights.shape[1]
+
+    assert weights.shape[-1] == N_CHANNELS, f"Light bases {light_bases.shape} do not match OLATs {olat_tensor.shape}"
+
+    if out is None:
+        out = np.empty(((N_ENVS,) if not single else ()) + pixel_shape + (N_CHANNELS,), dtype=np.float32)
+
+    assert out.dtype == np.float32 and out.flags.c_contiguous, "Output must be a contiguous float32 array"
+
+    olat_flat = olat_tensor.reshape(olat_tensor.shape[0], -1, N_CHANNELS)
+    out_flat = out.reshape(N_ENVS, -1, N_CHANNELS)
+    N_PIXELS = olat_flat.shape[1]
+
+    band = max(1, min(N_PIXELS, band_bytes // (4 * N_LIGHTS * N_CHANNELS)))
+
+    # Bands of a float32 tensor are multiplied in place, all others are decoded once into a float32 buffer
+    in_place = lut is None and light_index is None and olat_flat.dtype == np.float32
+    band_buffer = None if in_place else np.empty((N_LIGHTS, band, N_CHANNELS), dtype=np.float32)
+
+    stacked = N_ENVS <= CONTRACT_STACKED_MAX_ENVS
+    if stacked:
+        weights_t = np.ascontiguousarray(weights.transpose(2, 1, 0)).reshape(N_CHANNELS * N_ENVS, N_LIGHTS) # (C * E, L)
+        result_buffer = np.empty((N_CHANNELS * N_ENVS, band * N_CHANNELS), dtype=np.float32)
+    else:
+        weights_t = np.ascontiguousarray(weights.transpose(2, 1, 0)) # (C, E, L)
+        plane_buffer = np.empty((N_CHANNELS, N_LIGHTS, band), dtype=np.float32)
+        result_buffer = np.empty((N_ENVS, band), dtype=np.float32)
+
+    for start in range(0, N_PIXELS, band):
+        stop = min(start + band, N_PIXELS)
+        n = stop - start
+
+        if in_place:
+            olat_band = olat_flat[:, start:stop]
+        else:
+            olat_src = olat_flat[:, start:stop] if light_index is None else olat_flat[light_index, start:stop]
+            olat_band = band_buffer[:, :n]
+            if lut is not None:
+                np.take(lut, olat_src, out=olat_band)
+            else:
+                np.copyto(olat_band, olat_src, casting='unsafe')
+
+        if stacked:
+            # (C * E, L) x (L, n * C), only the products of each channel's weights with the same channel are kept
+            result_band = result_buffer[:, :n * N_CHANNELS]
+            np.matmul(weights_t, olat_band.reshape(N_LIGHTS, n * N_CHANNELS), out=result_band)
+            result_band = result_band.reshape(N_CHANNELS, N_ENVS, n, N_CHANNELS)
+        else:
+            planes = plane_buffer[:, :, :n]
+            np.copyto(planes.transpose(1, 2, 0), olat_band)
+
+        for c in range(N_CHANNELS):
+            if stacked:
+                result = result_band[c, :, :, c]
+            else:
+                result = np.matmul(weights_t[c], planes[c], out=result_buffer[:, :n])
+
+            if accumulate:
+                out_flat[:, start:stop, c] += result
+            else:
+                out_flat[:, start:stop, c] = result
+
+    return out
+
+
+def select_lights(light_bases, energy=None, top_k=None):
+    """ Selects the lights carrying most of the energy of one or several light bases, e.g. to skip the
+    negligible lights of an envmap (such as lights below the horizon of an outdoor map) while relighting.
+
+    Parameters
+    ----------
+    light_bases : np.array
+        (L, 3) light basis or (L, E, 3) stack of E light bases, the energy of a light is the sum of its absolute weights
+    energy : float, optional
+        fraction of the total energy the selected lights must at least carry, e.g. 0.99, default: None (no threshold)
+    top_k : int, optional
+        maximum number of lights to select, default: None (no limit)
+
+    Returns
+    -------
+    light_index : np.array
+        sorted indices of the selected lights (at least one)
+    dropped_energy : float
+        fraction of the total energy carried by the lights not selected
+    """
+
+    assert energy is not None or top_k is not None, "Either energy or top_k must be given"
+
+    light_energy = np.abs(np.asarray(light_bases, dtype=np.float64)).reshape(len(light_bases), -1).sum(axis=1)
+    order = np.argsort(-light_energy, kind='stable')
+
+    n_lights = len(order)
+    if energy is not None:
+        cumulative = np.cumsum(light_energy[order])
+        n_lights = int(np.searchsorted(cumulative, energy * cumulative[-1])) + 1
+    if top_k is not None:
+        n_lights = min(n_lights, top_k)
+    n_lights = max(1, min(n_lights, len(order)))
+
+    light_index = np.sort(order[:n_lights])
+
+    total_energy = light_energy.sum()
+    dropped_energy = 1. - light_energy[light_index].sum() / total_energy if total_energy > 0 else 0.
+
+    return light_index, float(dropped_energy)
+
+
+def stream_contract_olats(paths_to_olat, light_bases, out=None, chunk_size=8, workers=None):
+    """ Computes the weighted sum over lights like contract_olats, but decodes the OLATs from file while accumulating.
+    OLATs are decoded in chunks into two alternating buffers, the next chunk is decoded in the background while the
+    current one is accumulated. Peak memory is O((E + 2 * chunk_size) * H * W), independent of the number of lights.
+
+    Parameters
+    ----------
+    paths_to_olat : list of Path/str objects
+        (sorted) paths to individual OLATs
+    light_bases : np.array
+        (L, 3) weights for a single lighting or (L, E, 3) weights for E lightings
+    out : np.array, optional
+        preallocated float32 output of shape (H, W, 3) or (E, H, W, 3), default: None (allocate)
+    chunk_size : int, optional
+        number of OLATs decoded and accumulated at once, default: 8
+    workers : int, optional
+        number of decoding threads, default: None (number of CPUs)
+
+    Returns
+    -------
+    out : np.array
+        float32 relit image(s) of shape (H, W, 3) for (L, 3) bases or (E, H, W, 3) for (L, E, 3) bases
+    """
+
+    N_LIGHTS = len(paths_to_olat)
+    assert N_LIGHTS == len(light_bases), f"Got {N_LIGHTS} OLATs for {len(light_bases)} light weights"
+
+    first_olat = load_image_np(paths_to_olat[0], return_linear=True)
+    buffers = [np.empty((chunk_size,) + first_olat.shape, dtype=np.float32) for _ in range(2)]
+
+    if out is None:
+        out = np.empty(light_bases.shape[1:-1] + first_olat.shape, dtype=np.float32)
+    out.fill(0)
+
+    def load_chunk(start, buffer):
+        stop = min(start + chunk_size, N_LIGHTS)
+        return load_images_np(paths_to_olat[start:stop], out=buffer[:stop - start], workers=workers, return_linear=True, progress=False)
+
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_chunk = prefetcher.submit(load_chunk, 0, buffers[0])
+        for chunk_idx, start in enumerate(tqdm(range(0, N_LIGHTS, chunk_size))):
+            chunk = next_chunk.result()
+            if start + chunk_size < N_LIGHTS:
+                next_chunk = prefetcher.submit(load_chunk, start + chunk_size, buffers[(chunk_idx + 1) % 2])
+
+            contract_olats(chunk, light_bases[start:start + len(chunk)], out=out, accumulate=True)
+
+    return out
 
 
 class OLATRelight:
     """Base class for OLAT relighting"""
 
-    def __init__(self):
+    def __init__(self, cache=None):
+        """
+        Parameters
+        ----------
+        cache : RelightCache, optional
+            on-disk cache for preprocessed envmaps and their light bases, default: None (no caching)
+        """
         self.olat_tensors = dict()
+        self.olat_pixels = dict() # For masked OLATs: (flat foreground pixel indices, (H, W)) 
+        self.olat_luts = dict() # For uint8 OLATs: (256,) float32 table decoding the stored sRGB codes
+        self.olat_factors = dict() # For low-rank OLATs: (L, k) light factors, olat_tensors then holds the (k, ..., 3) image factors
+        self.olat_pyramids = dict() # Downscaled OLATs: {factor: (L, H // factor, W // factor, 3)}
+        self.olat_lights = dict() # For OLATs of a subset of the lights: (K,) indices of the loaded lights
         self.light_bases = dict()
         self.env_maps = dict()
+
+        self.cache = cache
+        self.env_map_keys = dict() # Cache keys of envmaps loaded from files
+        self.basis_key = None # Identifies the light basis projection, set by subclasses supporting caching
     
-    def load_olats(self, olat_id, paths_to_olat):
+    def load_olats(self, olat_id, paths_to_olat, olat_store=None, dtype=np.float32, workers=None, mask=None, pyramid_factors=None, light_index=None, downscale=None, target_size=None):
         """Load a set of olat images and store it under olat_id
         
         Parameters
@@ -21,12 +239,165 @@ class OLATRelight:
         olat_id : str
             identifier for this set of OLATs
         paths_to_olat : list of Path/str objects
-            (sorted) paths to individual OLATs
+            (sorted) paths to individual OLATs, may be None if olat_store already exists
+        olat_store : Path, str, optional
+            .npy file holding the linear OLAT tensor. If it exists, it is attached read-only via np.memmap
+            without decoding or copying (processes sharing it also share the page cache), otherwise the
+            OLATs are decoded into it first. An existing store must match dtype and, if paths_to_olat are
+            given, the size requested by downscale/target_size. Default: None (decode into memory)
+        dtype : np.dtype, optional
+            storage dtype of the OLATs (and of a newly written olat_store): np.float32, np.float16 or np.uint8.
+            np.uint8 keeps the original 8-bit sRGB codes, which are decoded through a lookup table while relighting.
+            Relighting always accumulates in float32. Default: np.float32
+        workers : int, optional
+            number of threads decoding the OLATs, default: None (number of CPUs)
+        mask : np.array, Path, str, optional
+            (H, W) foreground mask or path to it (e.g. segmentations/masks/000/CamXX.png). If given, only the P
+            foreground pixels are stored as a packed (L, P, 3) tensor and relit, default: None (store full frames)
+        pyramid_factors : list of int, optional
+            also build downscaled OLATs for progressive relighting, e.g. [8, 4, 2], see build_pyramid, default: None
+        light_index : np.array, optional
+            indices into paths_to_olat of the lights to load, e.g. from select_lights. Only these OLATs are decoded,
+            relighting then ignores the weights of all other lights. An existing olat_store holding all lights is
+            attached as is instead (relight_truncated then only reads the selected lights from it), a new olat_store
+            can not be written from a subset of the lights. Default: None (all lights)
+        downscale : int, optional
+            load the OLATs at 1 / downscale of their resolution (area-averaged in linear space), default: None (full resolution)
+        target_size : int, tuple, optional
+            load the OLATs with this size of the longer side or as (W, H), default: None (full resolution).
+            A full resolution mask is reduced to the same size.
         """
         assert olat_id not in self.olat_tensors.keys(), f"ID {olat_id} already in use"
 
-        self.olat_tensors[olat_id] = np.stack([load_image_np(str(p), return_linear=True) for p in tqdm(paths_to_olat)])
+        store_exists = olat_store is not None and os.path.isfile(str(olat_store))
+
+        if light_index is not None and not store_exists:
+            assert olat_store is None, f"OLAT store {olat_store} can not be written from a subset of the lights, load all lights into it first"
+            light_index = np.asarray(light_index)
+            if paths_to_olat is not None:
+                paths_to_olat = [paths_to_olat[i] for i in light_index]
+        else:
+            light_index = None # All lights of an existing store are attached
+
+        pixel_index = None
+        if mask is not None:
+            if not isinstance(mask, np.ndarray):
+                mask = load_mask_np(mask)
+            size = get_resized_size(mask.shape[0], mask.shape[1], downscale, target_size)
+            if size is not None:
+                mask = cv2.resize(mask.astype(np.float32), size, interpolation=cv2.INTER_AREA) > 0.5
+            pixel_index = np.flatnonzero(mask)
+
+        def attach(olat_tensor):
+            # Nothing is recorded under olat_id before its OLATs are loaded, so failed loads leave no partial entries
+            self.olat_tensors[olat_id] = olat_tensor
+            if light_index is not None:
+                self.olat_lights[olat_id] = light_index
+            if pixel_index is not None:
+                self.olat_pixels[olat_id] = (pixel_index, mask.shape)
+            if olat_tensor.dtype == np.uint8:
+                self.olat_luts[olat_id] = srgb8_to_linear_lut()
+            if pyramid_factors is not None:
+                try:
+                    self.build_pyramid(olat_id, pyramid_factors)
+                except BaseException:
+                    self.unload_olats(olat_id)
+                    raise
+
+        if store_exists:
+            olat_tensor = np.load(str(olat_store), mmap_mode='r')
+            assert paths_to_olat is None or len(paths_to_olat) == len(olat_tensor), f"OLAT store {olat_store} does not match the number of OLATs"
+            assert pixel_index is None or olat_tensor.shape[1] == len(pixel_index), f"OLAT store {olat_store} does not match the mask"
+            assert olat_tensor.dtype == np.dtype(dtype), f"OLAT store {olat_store} holds {olat_tensor.dtype} OLATs, not {np.dtype(dtype)}, remove it to rebuild it"
+
+            if paths_to_olat is not None and pixel_index is None:
+                W, H = read_image_size(paths_to_olat[0]) # Reads the header only
+                W, H = get_resized_size(H, W, downscale, target_size) or (W, H)
+                assert olat_tensor.shape[1:3] == (H, W), f"OLAT store {olat_store} holds {olat_tensor.shape[2]}x{olat_tensor.shape[1]} OLATs, not {W}x{H}, remove it to rebuild it"
+
+            attach(olat_tensor)
+            return
+
+        assert paths_to_olat is not None and len(paths_to_olat) > 0, "No OLATs to load"
+
+        dtype = np.dtype(dtype)
+        assert dtype in (np.float32, np.float16, np.uint8), f"Unsupported OLAT dtype {dtype}"
+        return_linear = dtype != np.uint8
+
+        first_olat = load_image_np(paths_to_olat[0], return_linear=return_linear, downscale=downscale, target_size=target_size)
+        if pixel_index is not None:
+            assert first_olat.shape[:2] == mask.shape, f"Mask shape {mask.shape} does not match OLAT shape {first_olat.shape}"
+            first_olat = first_olat.reshape(-1, first_olat.shape[-1])[pixel_index]
+        shape = (len(paths_to_olat),) + first_olat.shape
 
+        if olat_store is not None:
+            # Export to a unique temporary file, so processes building the same store never share a file
+            fd, tmp_store = tempfile.mkstemp(dir=str(Path(olat_store).parent), prefix=Path(olat_store).name + ".", suffix=".tmp")
+            os.close(fd)
+            olat_tensor = np.lib.format.open_memmap(tmp_store, mode='w+', dtype=dtype, shape=shape)
+        else:
+            olat_tensor = np.empty(shape, dtype=dtype)
+
+        try:
+            write_image_into(olat_tensor[0], first_olat)
+            load_images_np(paths_to_olat[1:], out=olat_tensor[1:], workers=workers, return_linear=return_linear, pixel_index=pixel_index,
+                           downscale=downscale, target_size=target_size)
+        except BaseException:
+            if olat_store is not None:
+                del olat_tensor
+                os.remove(tmp_store)
+            raise
+
+        if olat_store is not None:
+            olat_tensor.flush()
+            del olat_tensor
+            os.replace(tmp_store, str(olat_store))
+            olat_tensor = np.load(str(olat_store), mmap_mode='r')
+
+        attach(olat_tensor)
+
+    def build_pyramid(self, olat_id, factors=(8, 4, 2)):
+        """Build downscaled float32 copies of the OLATs olat_id for progressive relighting. Each level is
+        area-averaged in linear space from the next finer level.
+        
+        Parameters
+        ----------
+        olat_id : str
+            identifier of the (full frame, uncompressed) OLATs
+        factors : list of int, optional
+            downscaling factors of the levels, default: (8, 4, 2)
+        """
+        assert olat_id not in self.olat_pixels.keys() and olat_id not in self.olat_factors.keys(), "Pyramids require full frame, uncompressed OLATs"
+
+        olat_tensor = self.olat_tensors[olat_id]
+        lut = self.olat_luts.get(olat_id)
+        N_LIGHTS, H, W = olat_tensor.shape[:3]
+
+        self.olat_pyramids[olat_id] = dict()
+        finer, finer_factor = olat_tensor, 1
+
+        for factor in sorted(set(factors)):
+            assert factor > 1, f"Invalid pyramid factor {factor}"
+            level = np.empty((N_LIGHTS, H // factor, W // factor, olat_tensor.shape[-1]), dtype=np.float32)
+
+            for idx in range(N_LIGHTS):
+                frame = lut[finer[idx]] if finer_factor == 1 and lut is not None else np.asarray(finer[idx], dtype=np.float32)
+                level[idx] = cv2.resize(frame, (W // factor, H // factor), interpolation=cv2.INTER_AREA).reshape(level.shape[1:])
+
+            self.olat_pyramids[olat_id][factor] = level
+            finer, finer_factor = level, factor
+
+    def unload_olats(self, olat_id):
+        """Remove the OLATs olat_id and all data derived from them
+        
+        Parameters
+        ----------
+        olat_id : str
+            identifier of the OLATs to remove
+        """
+
+        for olat_dict in [self.olat_tensors, self.olat_pixels, self.olat_luts, self.olat_factors, self.olat_pyramids, self.olat_lights]:
+            olat_dict.pop(olat_id, None)
 
     def load_envmap(self, envmap_id, path_to_env, clip=-1., scale_to_0_1=True):
         """Load a hdr envmap and store it under envmap_id
@@ -45,6 +416,20 @@ class OLATRelight:
 
         assert envmap_id not in self.env_maps.keys(), f"ID {envmap_id} already in use"
 
+        if self.cache is not None:
+            env_key = self.cache.key(self.cache.file_hash(path_to_env), float(clip), bool(scale_to_0_1))
+            self.env_map_keys[envmap_id] = env_key
+
+            entry = self.cache.load(env_key)
+            if entry is not None:
+                self.env_maps[envmap_id] = entry["envmap"]
+
+                if self.basis_key is not None:
+                    entry = self.cache.load(self.cache.key(env_key, self.basis_key))
+                    if entry is not None:
+                        self.light_bases[envmap_id] = entry["basis"]
+                return
+
         hdr = np.float32(cv2.imread(str(path_to_env), -1))
         if clip >= 0:
             hdr[hdr > clip] = clip
@@ -55,6 +440,9 @@ class OLATRelight:
 
         self.env_maps[envmap_id] = hdr
 
+        if self.cache is not None:
+            self.cache.save(env_key, envmap=hdr)
+
     def generate_base(self, envmap_id):
         """Generate basis vector envmap envmap_id. Not implemented in base, overwrite.
         
@@ -66,8 +454,130 @@ class OLATRelight:
 
         assert False, "NOT IMPLEMENTED, OVERWRITE"
 
-    def relight(self, olat_id, envmap_id, scale=1.0, return_linear=False, regenerate_basis=False):
-        """Generate basis vector envmap envmap_id. Not implemented in base, overwrite.
+    def update_base(self, envmap_id, pixel_index, delta):
+        """Update the basis of envmap envmap_id after some of its pixels changed. Regenerates the full basis in base,
+        overwrite for incremental updates.
+        
+        Parameters
+        ----------
+        envmap_id : str
+            EnvMap identifier to update the base for
+        pixel_index : np.array
+            (N,) unique flat (row-major) indices of the changed envmap pixels
+        delta : np.array
+            (N, 3) change of the pixel values
+        """
+
+        self.generate_base(envmap_id)
+
+    def update_envmap(self, envmap_id, pixel_index, values):
+        """Change pixels of envmap envmap_id and update its basis (if it exists) accordingly
+        
+        Parameters
+        ----------
+        envmap_id : str
+            EnvMap identifier to change
+        pixel_index : np.array
+            (N,) unique flat (row-major) indices of the pixels to change
+        values : np.array
+            (N, 3) new (preprocessed) values of the pixels
+        """
+        assert envmap_id in self.env_maps.keys(), f"No envmap for id {envmap_id}"
+
+        env_map = self.env_maps[envmap_id]
+        env_flat = env_map.reshape(-1, env_map.shape[-1])
+
+        pixel_index = np.asarray(pixel_index).ravel()
+        values = np.asarray(values, dtype=env_map.dtype).reshape(len(pixel_index), -1)
+
+        delta = values - env_flat[pixel_index]
+        env_flat[pixel_index] = values
+
+        # The envmap no longer matches its file, so neither it nor its basis may be cached
+        self.env_map_keys.pop(envmap_id, None)
+
+        if envmap_id in self.light_bases.keys():
+            self.update_base(envmap_id, pixel_index, delta)
+
+    def relight_envmap_sequence(self, olat_id, envmap_id, envmap_frames, scale=1.0, return_linear=False, frame_batch=8, full_update_fraction=0.25):
+        """Relight the OLATs olat_id under an animated envmap, yielding one relit image per envmap frame.
+        Only the pixels changed since the previous frame are used to update the basis, so the per-frame cost
+        scales with the changed area. Bases of frame_batch frames are relit in one pass over the OLATs.
+        
+        Parameters
+        ----------
+        olat_id : str
+            OLAT identifier to use for relighting
+        envmap_id : str
+            EnvMap identifier under which the animated envmap is kept (created from the first frame if it does not exist)
+        envmap_frames : iterable
+            (preprocessed) envmap frames, each either a full (H, W, 3) envmap or a sparse (pixel_index, values) delta,
+            see update_envmap
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+        return_linear : bool, optional
+            return linear instead of sRGB, default: False
+        frame_batch : int, optional
+            number of frames relit in one pass over the OLATs, default: 8
+        full_update_fraction : float, optional
+            regenerate the full basis instead if more than this fraction of pixels changed, default: 0.25
+
+        Yields
+        ------
+        relit_img : np.array
+            float32 relit image (H, W, 3)
+        """
+
+        self.env_map_keys.pop(envmap_id, None)
+        bases = []
+
+        for envmap_frame in envmap_frames:
+            if isinstance(envmap_frame, tuple):
+                self.update_envmap(envmap_id, *envmap_frame)
+            elif envmap_id not in self.env_maps.keys():
+                self.env_maps[envmap_id] = np.array(envmap_frame, dtype=np.float32)
+            else:
+                env_map = self.env_maps[envmap_id]
+                envmap_frame = np.asarray(envmap_frame, dtype=env_map.dtype)
+                changed = np.flatnonzero(np.any(envmap_frame != env_map, axis=-1))
+
+                if len(changed) > full_update_fraction * env_map.shape[0] * env_map.shape[1]:
+                    env_map[...] = envmap_frame
+                    self.light_bases.pop(envmap_id, None)
+                elif len(changed) > 0:
+                    self.update_envmap(envmap_id, changed, envmap_frame.reshape(-1, env_map.shape[-1])[changed])
+
+            self.ensure_base(envmap_id)
+            bases.append(self.light_bases[envmap_id].copy())
+
+            if len(bases) == frame_batch:
+                yield from self.relight_with_bases(olat_id, np.stack(bases, axis=1), scale=scale, return_linear=return_linear)
+                bases = []
+
+        if len(bases) > 0:
+            yield from self.relight_with_bases(olat_id, np.stack(bases, axis=1), scale=scale, return_linear=return_linear)
+
+    def ensure_base(self, envmap_id, regenerate_basis=False):
+        """Generate the basis for envmap envmap_id if it does not exist yet and store it in the cache
+        
+        Parameters
+        ----------
+        envmap_id : str
+            EnvMap identifier to generate base for
+        regenerate_basis : bool, optional
+            regenerate the lighting basis even if it exists, default: False
+        """
+
+        if envmap_id in self.light_bases.keys() and not regenerate_basis:
+            return
+
+        self.generate_base(envmap_id)
+
+        if self.cache is not None and self.basis_key is not None and envmap_id in self.env_map_keys.keys():
+            self.cache.save(self.cache.key(self.env_map_keys[envmap_id], self.basis_key), basis=self.light_bases[envmap_id])
+
+    def relight(self, olat_id, envmap_id, scale=1.0, return_linear=False, regenerate_basis=False, out=None):
+        """Relight the OLATs olat_id with the EnvMap envmap_id
         
         Parameters
         ----------
@@ -81,41 +591,490 @@ class OLATRelight:
             return linear instead of sRGB, default: False
         regenerate_basis : bool, optional
             regenerate the lighting basis, default: False
+        out : np.array, optional
+            preallocated float32 (H, W, 3) array to write the linear relit image to, default: None
+
+        Returns
+        -------
+        relit_img : np.array
+            float32 relit image (H, W, 3)
         """
 
-        if envmap_id not in self.light_bases.keys() or regenerate_basis:
-            self.generate_base(envmap_id)
+        self.ensure_base(envmap_id, regenerate_basis)
+        
+        return self.relight_with_bases(olat_id, self.light_bases[envmap_id], scale=scale, return_linear=return_linear, out=out)
+
+    def relight_many(self, olat_id, envmap_ids, scale=1.0, return_linear=False, regenerate_basis=False, out=None):
+        """Relight the OLATs olat_id with several EnvMaps in a single pass over the OLAT data
         
-        relit_img = np.sum((scale * self.light_bases[envmap_id][:, None, None, :] * self.olat_tensors[olat_id]), axis=0)
+        Parameters
+        ----------
+        olat_id : str
+            OLAT identifier to use for relighting
+        envmap_ids : list of str
+            EnvMap identifiers to use for relighting
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+        return_linear : bool, optional
+            return linear instead of sRGB, default: False
+        regenerate_basis : bool, optional
+            regenerate the lighting bases, default: False
+        out : np.array, optional
+            preallocated float32 (E, H, W, 3) array to write the linear relit images to, default: None
+
+        Returns
+        -------
+        relit_imgs : np.array
+            float32 relit images (E, H, W, 3), ordered as envmap_ids
+        """
+
+        for envmap_id in envmap_ids:
+            self.ensure_base(envmap_id, regenerate_basis)
+
+        light_bases = np.stack([self.light_bases[envmap_id] for envmap_id in envmap_ids], axis=1) # (L, E, 3)
+
+        return self.relight_with_bases(olat_id, light_bases, scale=scale, return_linear=return_linear, out=out)
+
+    def relight_progressive(self, olat_id, envmap_id, scale=1.0, return_linear=False, regenerate_basis=False):
+        """Relight the OLATs olat_id with the EnvMap envmap_id from coarse to fine, e.g. for interactive previews.
+        Yields a relit image for every pyramid level (coarsest first, see build_pyramid) and finally the full resolution.
+        
+        Parameters
+        ----------
+        olat_id : str
+            OLAT identifier to use for relighting
+        envmap_id : str
+            EnvMap identifier to use for relighting
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+        return_linear : bool, optional
+            return linear instead of sRGB, default: False
+        regenerate_basis : bool, optional
+            regenerate the lighting basis, default: False
+
+        Yields
+        ------
+        factor : int
+            downscaling factor of the image, 1 for full resolution
+        relit_img : np.array
+            float32 relit image (H // factor, W // factor, 3)
+        """
+
+        self.ensure_base(envmap_id, regenerate_basis)
+        light_basis = scale * np.asarray(self.light_bases[envmap_id], dtype=np.float32)
+
+        # The levels only hold the loaded lights, see relight_with_bases
+        level_basis = light_basis[self.olat_lights[olat_id]] if olat_id in self.olat_lights.keys() else light_basis
+
+        for factor, level in sorted(self.olat_pyramids.get(olat_id, dict()).items(), reverse=True):
+            relit_img = contract_olats(level, level_basis)
+            yield factor, relit_img if return_linear else linear_to_srgb(relit_img)
+
+        yield 1, self.relight_with_bases(olat_id, light_basis, return_linear=return_linear)
+
+    def relight_truncated(self, olat_id, envmap_id, energy=0.99, top_k=None, paths_to_olat=None, scale=1.0, return_linear=False, regenerate_basis=False, **load_kwargs):
+        """Relight the OLATs olat_id with the EnvMap envmap_id using only the lights that matter, see select_lights.
+        If the OLATs are not loaded yet, only the OLATs of the selected lights are decoded from paths_to_olat.
+        
+        Parameters
+        ----------
+        olat_id : str
+            OLAT identifier to use for relighting
+        envmap_id : str
+            EnvMap identifier to use for relighting
+        energy : float, optional
+            fraction of the envmap energy the used lights must at least carry, default: 0.99
+        top_k : int, optional
+            maximum number of lights to use, default: None (no limit)
+        paths_to_olat : list of Path/str objects, optional
+            (sorted) paths to all individual OLATs, required if olat_id is not loaded yet and no existing olat_store
+            is given, default: None
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+        return_linear : bool, optional
+            return linear instead of sRGB, default: False
+        regenerate_basis : bool, optional
+            regenerate the lighting basis, default: False
+        load_kwargs :
+            further arguments of load_olats (e.g. dtype, mask) if olat_id is not loaded yet
+
+        Returns
+        -------
+        relit_img : np.array
+            float32 relit image (H, W, 3)
+        dropped_energy : float
+            fraction of the envmap energy carried by the lights not used
+        """
+
+        self.ensure_base(envmap_id, regenerate_basis)
+        light_basis = np.asarray(self.light_bases[envmap_id], dtype=np.float32)
+        light_index, dropped_energy = select_lights(light_basis, energy=energy, top_k=top_k)
+
+        if olat_id not in self.olat_tensors.keys():
+            assert paths_to_olat is not None or load_kwargs.get("olat_store") is not None, f"OLATs {olat_id} are not loaded and no paths to them were given"
+            self.load_olats(olat_id, paths_to_olat, light_index=light_index, **load_kwargs)
+
+        assert olat_id not in self.olat_factors.keys(), "Truncated relighting requires uncompressed OLATs"
+
+        # Use the selected lights among the loaded ones
+        loaded_lights = self.olat_lights.get(olat_id, np.arange(len(light_basis)))
+        rows = np.flatnonzero(np.isin(loaded_lights, light_index))
+        assert len(rows) > 0, f"None of the selected lights of OLATs {olat_id} are loaded"
+        if len(rows) < len(light_index):
+            # Some selected lights are not loaded, their energy is dropped as well
+            dropped_energy = 1. - np.abs(light_basis[loaded_lights[rows]]).sum() / max(np.abs(light_basis).sum(), 1e-12)
+
+        relit_img = contract_olats(self.olat_tensors[olat_id], scale * light_basis[loaded_lights[rows]],
+                                   lut=self.olat_luts.get(olat_id), light_index=rows if len(rows) < len(loaded_lights) else None)
+        if olat_id in self.olat_pixels.keys():
+            relit_img = self.unpack_pixels(olat_id, relit_img)
+
+        if not return_linear:
+            relit_img = linear_to_srgb(relit_img)
+
+        return relit_img, float(dropped_energy)
+
+    def relight_streaming(self, paths_to_olat, envmap_ids, scale=1.0, return_linear=False, regenerate_basis=False, chunk_size=8, workers=None, out=None):
+        """Relight OLATs directly from their files with one or several EnvMaps, without loading the OLAT stack.
+        Use this for OLATs too large to be held in memory, see stream_contract_olats.
+        
+        Parameters
+        ----------
+        paths_to_olat : list of Path/str objects
+            (sorted) paths to individual OLATs
+        envmap_ids : str or list of str
+            EnvMap identifier or identifiers to use for relighting
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+        return_linear : bool, optional
+            return linear instead of sRGB, default: False
+        regenerate_basis : bool, optional
+            regenerate the lighting bases, default: False
+        chunk_size : int, optional
+            number of OLATs decoded and accumulated at once, default: 8
+        workers : int, optional
+            number of decoding threads, default: None (number of CPUs)
+        out : np.array, optional
+            preallocated float32 (H, W, 3) or (E, H, W, 3) array to write the linear relit image(s) to, default: None
+
+        Returns
+        -------
+        relit_img : np.array
+            float32 relit image (H, W, 3) for a single envmap_id or images (E, H, W, 3) for a list
+        """
+
+        single = isinstance(envmap_ids, str)
+        if single:
+            envmap_ids = [envmap_ids]
+
+        for envmap_id in envmap_ids:
+            self.ensure_base(envmap_id, regenerate_basis)
+
+        light_bases = scale * np.stack([self.light_bases[envmap_id] for envmap_id in envmap_ids], axis=1).astype(np.float32) # (L, E, 3)
+        if single:
+            light_bases = light_bases[:, 0]
+
+        relit_img = stream_contract_olats(paths_to_olat, light_bases, out=out, chunk_size=chunk_size, workers=workers)
+
+        if return_linear:
+            return relit_img
+        
+        return linear_to_srgb(relit_img)
+
+    def relight_with_bases(self, olat_id, light_bases, scale=1.0, return_linear=False, out=None):
+        """Relight the OLATs olat_id with explicitly given light bases
+        
+        Parameters
+        ----------
+        olat_id : str
+            OLAT identifier to use for relighting
+        light_bases : np.array
+            (L, 3) light basis or (L, E, 3) stack of E light bases
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+        return_linear : bool, optional
+            return linear instead of sRGB, default: False
+        out : np.array, optional
+            preallocated float32 (H, W, 3) or (E, H, W, 3) array to write the linear relit image(s) to, default: None
+
+        Returns
+        -------
+        relit_img : np.array
+            float32 relit image (H, W, 3) or images (E, H, W, 3)
+        """
+
+        light_bases = scale * np.asarray(light_bases, dtype=np.float32)
+
+        if olat_id in self.olat_lights.keys():
+            # Only a subset of the lights is loaded
+            light_bases = light_bases[self.olat_lights[olat_id]]
+
+        if olat_id in self.olat_factors.keys():
+            # Project the light bases onto the k light factors
+            light_bases = np.einsum('lk,l...->k...', self.olat_factors[olat_id], light_bases)
+
+        if olat_id in self.olat_pixels.keys():
+            relit_img = self.unpack_pixels(olat_id, contract_olats(self.olat_tensors[olat_id], light_bases, lut=self.olat_luts.get(olat_id)), out=out)
+        else:
+            relit_img = contract_olats(self.olat_tensors[olat_id], light_bases, out=out, lut=self.olat_luts.get(olat_id))
 
         if return_linear:
             return relit_img
         
         return linear_to_srgb(relit_img)
 
+    def compress_olats(self, olat_id, rank=None, max_error=None, band_bytes=RELIGHT_BAND_BYTES):
+        """Replace the OLATs olat_id by a rank-k factorization (truncated SVD of the (L, H*W*3) OLAT matrix).
+        The factorization is computed out-of-core from the (L, L) Gram matrix, accumulated over pixel bands,
+        so memory-mapped OLATs are never loaded as a whole. Afterwards, relighting costs k instead of L
+        products per pixel.
+        
+        Parameters
+        ----------
+        olat_id : str
+            identifier of the OLATs to compress
+        rank : int, optional
+            rank k of the factorization, default: None (use max_error)
+        max_error : float, optional
+            if rank is None, use the smallest rank with a relative reconstruction error below this, default: None
+        band_bytes : int, optional
+            size of the float32 OLAT band processed at once, default: RELIGHT_BAND_BYTES
+
+        Returns
+        -------
+        rel_errors : np.array
+            (L,) relative Frobenius reconstruction error of the OLATs for each rank 1, ..., L
+        """
+        assert olat_id not in self.olat_factors.keys(), f"OLATs {olat_id} are already compressed"
+        assert rank is not None or max_error is not None, "Either rank or max_error must be given"
+
+        olat_tensor = self.olat_tensors[olat_id]
+        lut = self.olat_luts.get(olat_id)
+        N_LIGHTS = olat_tensor.shape[0]
+        olat_flat = olat_tensor.reshape(N_LIGHTS, -1)
+
+        gram = np.zeros((N_LIGHTS, N_LIGHTS), dtype=np.float64)
+        band = max(1, band_bytes // (4 * N_LIGHTS))
+        for start in tqdm(range(0, olat_flat.shape[1], band)):
+            olat_band = lut[olat_flat[:, start:start + band]] if lut is not None else np.asarray(olat_flat[:, start:start + band], dtype=np.float32)
+            gram += olat_band @ olat_band.T
+
+        eigvals, eigvecs = np.linalg.eigh(gram)
+        eigvals, eigvecs = np.clip(eigvals[::-1], 0, None), eigvecs[:, ::-1]
+
+        rel_errors = np.sqrt(np.clip(eigvals.sum() - np.cumsum(eigvals), 0, None) / eigvals.sum())
+
+        if rank is None:
+            rank = int(np.searchsorted(-rel_errors, -max_error)) + 1
+        rank = min(rank, N_LIGHTS)
+
+        light_factors = np.ascontiguousarray(eigvecs[:, :rank], dtype=np.float32) # (L, k), orthonormal columns
+        image_factors = contract_olats(olat_tensor, np.repeat(light_factors[:, :, None], olat_tensor.shape[-1], axis=2), lut=lut) # (k, ..., 3)
+
+        self.olat_factors[olat_id] = light_factors
+        self.olat_tensors[olat_id] = image_factors
+        self.olat_luts.pop(olat_id, None)
+
+        return rel_errors
+
+    def unpack_pixels(self, olat_id, packed, out=None):
+        """Scatter packed foreground pixels of the masked OLATs olat_id back into full frames
+        
+        Parameters
+        ----------
+        olat_id : str
+            identifier of the masked OLATs the pixels belong to
+        packed : np.array
+            (..., P, 3) packed foreground pixels
+        out : np.array, optional
+            preallocated float32 (..., H, W, 3) array to write the frames to, default: None
+
+        Returns
+        -------
+        frames : np.array
+            float32 (..., H, W, 3) frames, background pixels are zero
+        """
+
+        pixel_index, (H, W) = self.olat_pixels[olat_id]
+        batch_shape, N_CHANNELS = packed.shape[:-2], packed.shape[-1]
+
+        if out is None:
+            out = np.zeros(batch_shape + (H, W, N_CHANNELS), dtype=np.float32)
+        else:
+            out.fill(0)
+
+        out.reshape(batch_shape + (H * W, N_CHANNELS))[..., pixel_index, :] = packed
+
+        return out
+
 
 class OLATRelightWithEnvMap(OLATRelight):
     """Class for OLAT relighting using the OLAT envmaps"""
-    def __init__(self, path_to_olat_envmaps):
-        super().__init__()
+    def __init__(self, path_to_olat_envmaps, cache=None):
+        """
+        Parameters
+        ----------
+        path_to_olat_envmaps : Path, str
+            directory containing the OLAT envmap .pngs
+        cache : RelightCache, optional
+            on-disk cache for the OLAT envmaps, preprocessed envmaps and their light bases, default: None
+        """
+        super().__init__(cache)
+
+        hdr_map_paths = list(sorted(Path(path_to_olat_envmaps).glob(f'*.png')))
+
+        entry = None
+        if self.cache is not None:
+            self.basis_key = self.cache.key(*[self.cache.file_hash(p) for p in hdr_map_paths])
+            entry = self.cache.load(self.basis_key)
+
+        if entry is not None:
+            self.OLAT_envmaps_shape = tuple(entry["shape"])
+            self.OLAT_envmaps_sparse = [
+                scipy.sparse.csr_matrix((entry[f"data_{c}"], entry[f"indices_{c}"], entry[f"indptr_{c}"]), shape=tuple(entry["csr_shape"]))
+                for c in range(3)
+            ]
+        else:
+            self.load_olat_envmaps(hdr_map_paths)
+
+            if self.cache is not None:
+                arrays = dict(shape=np.array(self.OLAT_envmaps_shape), csr_shape=np.array(self.OLAT_envmaps_sparse[0].shape))
+                for c in range(3):
+                    arrays[f"data_{c}"] = self.OLAT_envmaps_sparse[c].data
+                    arrays[f"indices_{c}"] = self.OLAT_envmaps_sparse[c].indices
+                    arrays[f"indptr_{c}"] = self.OLAT_envmaps_sparse[c].indptr
+                self.cache.save(self.basis_key, **arrays)
+
+        self.OLAT_envmaps_div = np.stack([np.asarray(self.OLAT_envmaps_sparse[c].sum(axis=1)).ravel() for c in range(3)], axis=1) # (L, 3)
+        self.OLAT_envmaps_fft = None # Row-wise spectra of the OLAT envmap supports, computed on first rotation sweep
+        self.OLAT_envmaps_csc = None # Column-major copy of the OLAT envmap supports, computed on first incremental update
+
+    def load_olat_envmaps(self, hdr_map_paths):
+        """Loads the OLAT envmaps into per-channel sparse matrices
+        
+        Parameters
+        ----------
+        hdr_map_paths : list of Path
+            sorted paths to the OLAT envmap .pngs
+        """
 
-        self.OLAT_envmaps = [] 
+        # Each OLAT envmap is zero apart from a small lobe, so only its nonzero support is stored:
+        # one (L, H*W) CSR matrix over envmap pixels per channel
+        indices = [[] for _ in range(3)]
+        weights = [[] for _ in range(3)]
+        counts = [[0] for _ in range(3)]
 
         # Load envmaps
-        hdr_map_paths = list(sorted(Path(path_to_olat_envmaps).glob(f'*.png')))
         for idx in tqdm(range(len(hdr_map_paths))):
-            in_image = np.float32(cv2.imread(hdr_map_paths[idx], -1)) / 255.0
+            in_image = np.float32(cv2.imread(str(hdr_map_paths[idx]), -1)) / 255.0
             if in_image.max() < 0.5:
                 continue # Skip fullbright OLATs
 
-            self.OLAT_envmaps.append(in_image) 
+            self.OLAT_envmaps_shape = in_image.shape
+            for c in range(3):
+                channel = in_image[..., c].ravel()
+                support = np.flatnonzero(channel)
+                indices[c].append(support.astype(np.int32))
+                weights[c].append(channel[support])
+                counts[c].append(len(support))
+
+        N_LIGHTS = len(counts[0]) - 1
+        N_PIXELS = self.OLAT_envmaps_shape[0] * self.OLAT_envmaps_shape[1]
 
-        self.OLAT_envmaps = np.stack(self.OLAT_envmaps)
-        self.OLAT_envmaps_div = np.sum((self.OLAT_envmaps), axis=(1, 2))
+        self.OLAT_envmaps_sparse = [
+            scipy.sparse.csr_matrix((np.concatenate(weights[c]), np.concatenate(indices[c]), np.cumsum(counts[c])), shape=(N_LIGHTS, N_PIXELS))
+            for c in range(3)
+        ]
     
     def generate_base(self, envmap_id, scale=1.):
         assert envmap_id in self.env_maps.keys(), f"No envmap for id {self.env_maps}"
 
-        basis = scale * np.sum((self.env_maps[envmap_id][None,] * self.OLAT_envmaps), axis=(1, 2)) / self.OLAT_envmaps_div
+        env_map = self.env_maps[envmap_id]
+        assert env_map.shape == self.OLAT_envmaps_shape, f"EnvMap shape {env_map.shape} does not match OLAT envmaps {self.OLAT_envmaps_shape}"
+
+        basis = np.stack([self.OLAT_envmaps_sparse[c] @ env_map[..., c].ravel() for c in range(3)], axis=1)
+
+        self.light_bases[envmap_id] = scale * basis / self.OLAT_envmaps_div
+
+    def update_base(self, envmap_id, pixel_index, delta):
+        """Incrementally update the (scale 1) basis of envmap envmap_id from the changed pixels only, see OLATRelight.update_base"""
+
+        if self.OLAT_envmaps_csc is None:
+            self.OLAT_envmaps_csc = [self.OLAT_envmaps_sparse[c].tocsc() for c in range(3)] # Column access by envmap pixel
+
+        basis = self.light_bases[envmap_id]
+        for c in range(3):
+            basis[:, c] += (self.OLAT_envmaps_csc[c][:, pixel_index] @ delta[:, c]) / self.OLAT_envmaps_div[:, c]
+
+    def _generate_support_fft(self):
+        """Computes the row-wise spectra of all envmap rows covered by the support of an OLAT envmap"""
+
+        H, W, _ = self.OLAT_envmaps_shape
+
+        # Unique (light, row) pairs, sorted by light
+        light_rows = np.unique(np.concatenate([
+            self.OLAT_envmaps_sparse[c].tocoo().row.astype(np.int64) * H + self.OLAT_envmaps_sparse[c].indices // W
+            for c in range(3)
+        ]))
+
+        rows = np.zeros((len(light_rows), W, 3), dtype=np.float32)
+        for c in range(3):
+            coo = self.OLAT_envmaps_sparse[c].tocoo()
+            pair = np.searchsorted(light_rows, coo.row.astype(np.int64) * H + coo.col // W)
+            rows[pair, coo.col % W, c] = coo.data
+
+        pair_lights = light_rows // H
+        self.OLAT_envmaps_fft = {
+            "rows": light_rows % H, # envmap row of each pair
+            "offsets": np.searchsorted(pair_lights, np.arange(len(self.OLAT_envmaps_div))), # first pair of each light
+            "spectra": np.fft.rfft(rows, axis=1).astype(np.complex64) # (P, K, 3)
+        }
+
+    def generate_rotated_bases(self, envmap_id, n_rotations=360, scale=1.):
+        """Generate the basis vectors for n_rotations azimuthal rotations of envmap envmap_id at once.
+        Rotation i corresponds to np.roll(envmap, i * W / n_rotations, axis=1) (fractional shifts are
+        interpolated in the Fourier domain). All rotations are obtained from a single circular
+        cross-correlation of the envmap with the OLAT envmaps along the azimuth (column) axis.
+
+        Parameters
+        ----------
+        envmap_id : str
+            EnvMap identifier to generate bases for
+        n_rotations : int, optional
+            number of equally spaced azimuthal rotations, default: 360
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+
+        Returns
+        -------
+        light_bases : np.array
+            float32 (L, n_rotations, 3) light bases, can directly be passed to relight_with_bases
+        """
+        assert envmap_id in self.env_maps.keys(), f"No envmap for id {envmap_id}"
+
+        if self.OLAT_envmaps_fft is None:
+            self._generate_support_fft()
+
+        env_map = self.env_maps[envmap_id]
+        W = env_map.shape[1]
+        env_fft = np.fft.rfft(env_map, axis=1).astype(np.complex64) # (H, K, 3)
+
+        # Cross-power spectrum summed over the support rows of each light: (L, K, 3)
+        support_fft = self.OLAT_envmaps_fft
+        cross_power = support_fft["spectra"] * np.conj(env_fft[support_fft["rows"]])
+        spectrum = np.add.reduceat(cross_power, support_fft["offsets"], axis=0)
+
+        # Evaluate the real inverse transform at the requested shifts
+        K = spectrum.shape[1]
+        k_weights = np.full(K, 2.)
+        k_weights[0] = 1.
+        if W % 2 == 0:
+            k_weights[-1] = 1.
+
+        shifts = np.arange(n_rotations) * W / n_rotations
+        phases = k_weights * np.exp(2j * np.pi * np.outer(shifts, np.arange(K)) / W) # (N, K)
+        correlation = np.real(np.tensordot(phases, spectrum, axes=(1, 1))) / W # (N, L, 3)
+
+        light_bases = scale * correlation.transpose(1, 0, 2) / self.OLAT_envmaps_div[:, None, :]
 
-        self.light_bases[envmap_id] = basis
\ No newline at end of file
+        return light_bases.astype(np.float32)
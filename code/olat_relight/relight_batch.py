@@ -0,0 +1,366 @@
+from olat_relight.olat_relight import OLATRelightWithEnvMap
+from olat_relight.relight_cache import RelightCache
+from utils.metadata_readers import load_light_rig
+from utils.avif_image_utils import linear_to_srgb8
+
+import numpy as np
+import cv2, os, time, queue
+import multiprocessing as mp
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+def find_relight_units(dataset_dir, subjects=None, poses=None, cams=None, image_dir="images_processed"):
+    """ Lists the (subject, pose, camera) work units found in the dataset
+
+    Parameters
+    ----------
+    dataset_dir : Path, str
+        path to the dataset root
+    subjects : list of str, optional
+        subjects to include, default: None (all)
+    poses : list of str, optional
+        poses to include, default: None (all)
+    cams : list of str, optional
+        cameras to include (e.g. "Cam01"), default: None (all)
+    image_dir : str, optional
+        name of the image directory, default: "images_processed"
+
+    Returns
+    -------
+    units : list of tuple
+        (subject, pose, cam) work units
+    """
+
+    dataset_dir = Path(dataset_dir)
+    units = []
+
+    for subject_dir in sorted(dataset_dir.glob("SUBJECT_*")):
+        if subjects is not None and subject_dir.name not in subjects:
+            continue
+
+        for pose_dir in sorted(subject_dir.glob("POSE_*")):
+            if poses is not None and pose_dir.name not in poses:
+                continue
+
+            for cam_dir in sorted((pose_dir / image_dir).glob("Cam*")):
+                if cams is not None and cam_dir.name not in cams:
+                    continue
+
+                units.append((subject_dir.name, pose_dir.name, cam_dir.name))
+
+    return units
+
+
+def read_relight_light_img(dataset_dir, subject):
+    """ Reads the image index of each light of subject, ordered as the OLAT envmaps (door lights included)
+
+    Parameters
+    ----------
+    dataset_dir : Path, str
+        path to the dataset root
+    subject : str
+        subject to read the light info of
+
+    Returns
+    -------
+    light_img : np.array
+        image index of each light (LightRig.light_frame of utils.load_light_rig)
+    """
+
+    shared = Path(dataset_dir) / subject / "shared"
+
+    # Door lights are not excluded, their lighting can still be used for OLAT relighting
+    return load_light_rig(shared / "LSX_light_positions_aligned.pc", shared / "LSX3_light_z_spiral.txt", OLAT_START=14, OLAT_FB_MODULO=21).light_frame
+
+
+def find_olat_paths(dataset_dir, unit, light_img, image_dir="images_processed"):
+    """ Lists the OLAT images of a (subject, pose, camera) work unit, ordered as the OLAT envmaps
+
+    Parameters
+    ----------
+    dataset_dir : Path, str
+        path to the dataset root
+    unit : tuple
+        (subject, pose, cam) work unit
+    light_img : np.array
+        image index of each light, see read_relight_light_img
+    image_dir : str, optional
+        name of the image directory, default: "images_processed"
+
+    Returns
+    -------
+    olat_paths : list of Path
+        path of the OLAT image of each light
+    """
+
+    subject, pose, cam = unit
+    image_paths = sorted((Path(dataset_dir) / subject / pose / image_dir / cam).glob("*.avif"))
+    return [image_paths[i] for i in light_img]
+
+
+class RelightBatchWorker:
+    """Relights (subject, pose, camera) work units under a set of envmaps. Decoding of the next unit, relighting
+    of the current unit and encoding of its outputs run as overlapped pipeline stages."""
+
+    def __init__(self, dataset_dir, out_dir, envmap_paths, path_to_olat_envmaps="./olat_relight/OLAT_EnvMaps",
+                 out_ext=".png", scale=1.0, envmap_batch=8, dtype=np.uint8, use_mask=False,
+                 cache_dir=None, decode_workers=None, encode_workers=4, image_dir="images_processed"):
+        """
+        Parameters
+        ----------
+        dataset_dir : Path, str
+            path to the dataset root
+        out_dir : Path, str
+            outputs are written to out_dir/SUBJECT/POSE/CAM/ENVMAP{out_ext}
+        envmap_paths : list of Path, str
+            paths to the hdr envmaps, the file stem is used as identifier
+        path_to_olat_envmaps : Path, str, optional
+            directory containing the OLAT envmap .pngs, default: "./olat_relight/OLAT_EnvMaps"
+        out_ext : str, optional
+            ".png" (8-bit sRGB) or ".exr" (linear float), default: ".png"
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+        envmap_batch : int, optional
+            number of envmaps relit in one pass over the OLATs, default: 8
+        dtype : np.dtype, optional
+            storage dtype of the OLATs, see OLATRelight.load_olats, default: np.uint8
+        use_mask : bool, optional
+            only relight the foreground given by the segmentation masks, default: False
+        cache_dir : Path, str, optional
+            directory of a RelightCache shared by all workers, default: None
+        decode_workers : int, optional
+            number of decoding threads, default: None (number of CPUs)
+        encode_workers : int, optional
+            number of encoding threads, default: 4
+        image_dir : str, optional
+            name of the image directory, default: "images_processed"
+        """
+
+        assert out_ext in (".png", ".exr"), f"Unsupported output format {out_ext}"
+
+        self.dataset_dir = Path(dataset_dir)
+        self.out_dir = Path(out_dir)
+        self.out_ext = out_ext
+        self.scale = scale
+        self.envmap_batch = envmap_batch
+        self.dtype = dtype
+        self.use_mask = use_mask
+        self.decode_workers = decode_workers
+        self.encode_workers = encode_workers
+        self.image_dir = image_dir
+
+        cache = RelightCache(cache_dir) if cache_dir is not None else None
+        self.relighter = OLATRelightWithEnvMap(path_to_olat_envmaps, cache=cache)
+
+        self.envmap_ids = []
+        for envmap_path in envmap_paths:
+            envmap_id = Path(envmap_path).stem
+            self.relighter.load_envmap(envmap_id, envmap_path)
+            self.relighter.ensure_base(envmap_id)
+            self.envmap_ids.append(envmap_id)
+
+        self.light_img = dict() # Per subject
+
+    def output_path(self, unit, envmap_id):
+        subject, pose, cam = unit
+        return self.out_dir / subject / pose / cam / f"{envmap_id}{self.out_ext}"
+
+    def pending_envmaps(self, unit):
+        """Returns the envmap ids of unit whose outputs do not exist yet"""
+        return [envmap_id for envmap_id in self.envmap_ids if not self.output_path(unit, envmap_id).is_file()]
+
+    def olat_paths(self, unit):
+        subject = unit[0]
+        if subject not in self.light_img.keys():
+            self.light_img[subject] = read_relight_light_img(self.dataset_dir, subject)
+
+        return find_olat_paths(self.dataset_dir, unit, self.light_img[subject], self.image_dir)
+
+    def decode(self, unit):
+        """Decode stage: loads the OLATs of unit into the relighter"""
+
+        subject, pose, cam = unit
+        mask = self.dataset_dir / subject / pose / "segmentations" / "masks" / "000" / f"{cam}.png" if self.use_mask else None
+
+        olat_id = "_".join(unit)
+        self.relighter.load_olats(olat_id, self.olat_paths(unit), dtype=self.dtype, workers=self.decode_workers, mask=mask)
+
+        return olat_id
+
+    def encode(self, path, image):
+        """Encode stage: writes a linear relit image, via a temporary file so interrupted writes are never taken as done"""
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.stem}.tmp{path.suffix}")
+
+        if self.out_ext == ".png":
+            cv2.imwrite(str(tmp_path), linear_to_srgb8(image))
+        else:
+            cv2.imwrite(str(tmp_path), image)
+        os.replace(tmp_path, path)
+
+    def run(self, next_unit, on_done):
+        """Processes work units until next_unit returns None. A failing unit is reported and skipped, the
+        remaining units are still processed.
+
+        Parameters
+        ----------
+        next_unit : callable
+            returns the next (subject, pose, cam) work unit or None if there are no units left
+        on_done : callable
+            called as on_done(unit, n_written, n_skipped, seconds, error) for every finished unit, error is None
+            or the exception the unit failed with
+        """
+
+        def fetch_and_decode():
+            # Skip units which are already done or can not be decoded
+            while True:
+                unit = next_unit()
+                if unit is None:
+                    return None
+
+                pending = self.pending_envmaps(unit)
+                if len(pending) == 0:
+                    on_done(unit, 0, len(self.envmap_ids), 0., None)
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    return unit, pending, self.decode(unit), start
+                except Exception as error:
+                    self.relighter.unload_olats("_".join(unit))
+                    on_done(unit, 0, len(self.envmap_ids) - len(pending), time.perf_counter() - start, error)
+
+        with ThreadPoolExecutor(max_workers=1) as decoder, ThreadPoolExecutor(max_workers=self.encode_workers) as encoder:
+            next_item = decoder.submit(fetch_and_decode)
+
+            while True:
+                item = next_item.result()
+                if item is None:
+                    break
+
+                # Decode the next unit while relighting this one
+                next_item = decoder.submit(fetch_and_decode)
+                unit, pending, olat_id, start = item
+
+                encodes = []
+                try:
+                    for batch_start in range(0, len(pending), self.envmap_batch):
+                        batch = pending[batch_start:batch_start + self.envmap_batch]
+                        relit_imgs = self.relighter.relight_many(olat_id, batch, scale=self.scale, return_linear=True)
+
+                        # Encode this batch while relighting the next one, at most two batches are held in memory
+                        for encode in encodes:
+                            encode.result()
+                        encodes = [encoder.submit(self.encode, self.output_path(unit, envmap_id), relit_img) for envmap_id, relit_img in zip(batch, relit_imgs)]
+
+                    for encode in encodes:
+                        encode.result()
+                    error = None
+                except Exception as unit_error:
+                    for encode in encodes:
+                        encode.exception() # Wait, so no encode of this unit is still running
+                    error = unit_error
+
+                self.relighter.unload_olats(olat_id)
+                n_missing = len(self.pending_envmaps(unit)) if error is not None else 0
+                on_done(unit, len(pending) - n_missing, len(self.envmap_ids) - len(pending), time.perf_counter() - start, error)
+
+
+def _worker_main(worker_id, worker_kwargs, tasks, results):
+    worker = RelightBatchWorker(**worker_kwargs)
+
+    def next_unit():
+        return tasks.get()
+
+    def on_done(unit, n_written, n_skipped, seconds, error):
+        # Exceptions are sent as text, they are not necessarily picklable
+        results.put((unit, n_written, n_skipped, seconds, None if error is None else f"{type(error).__name__}: {error}"))
+
+    worker.run(next_unit, on_done)
+    results.put(worker_id)
+
+
+def run_relight_batch(units, n_processes=1, **worker_kwargs):
+    """ Relights all work units with a pool of worker processes, each running a RelightBatchWorker pipeline.
+    Outputs which already exist are skipped, so interrupted runs can be resumed. Units which fail are reported
+    and skipped, as are the units of workers which exit unexpectedly.
+
+    Parameters
+    ----------
+    units : list of tuple
+        (subject, pose, cam) work units, e.g. from find_relight_units
+    n_processes : int, optional
+        number of worker processes, default: 1
+    worker_kwargs :
+        arguments of RelightBatchWorker
+
+    Returns
+    -------
+    n_written : int
+        number of relit images written
+    """
+
+    ctx = mp.get_context("spawn")
+    tasks, results = ctx.Queue(), ctx.Queue()
+
+    for unit in units:
+        tasks.put(unit)
+    for _ in range(n_processes):
+        tasks.put(None)
+
+    processes = [ctx.Process(target=_worker_main, args=(worker_id, worker_kwargs, tasks, results)) for worker_id in range(n_processes)]
+    for process in processes:
+        process.start()
+
+    start = time.perf_counter()
+    n_written, n_skipped, n_units = 0, 0, 0
+    failed = [] # (unit, error)
+    running = set(range(n_processes))
+    crashed = [] # Workers which exited without reporting their end
+
+    while len(running) > 0:
+        try:
+            result = results.get(timeout=10)
+        except queue.Empty:
+            # Results of a worker are flushed before it exits, so a dead worker which did not report its end crashed
+            for worker_id in list(running):
+                if not processes[worker_id].is_alive():
+                    running.discard(worker_id)
+                    crashed.append(worker_id)
+                    print(f"Relight worker {worker_id} exited unexpectedly (exit code {processes[worker_id].exitcode})")
+            continue
+
+        if isinstance(result, int):
+            running.discard(result)
+            continue
+
+        unit, unit_written, unit_skipped, seconds, error = result
+        n_written += unit_written
+        n_skipped += unit_skipped
+        n_units += 1
+
+        elapsed = time.perf_counter() - start
+        if error is not None:
+            failed.append((unit, error))
+            print(f"[{n_units}/{len(units)}] {'_'.join(unit)}: FAILED after writing {unit_written} images: {error}")
+        else:
+            print(f"[{n_units}/{len(units)}] {'_'.join(unit)}: wrote {unit_written}, skipped {unit_skipped} in {seconds:.1f}s "
+                  f"| total {n_written} images, {n_written / elapsed:.2f} images/s")
+
+    for process in processes:
+        process.join()
+
+    elapsed = time.perf_counter() - start
+    print(f"Wrote {n_written} images ({n_skipped} already existed) in {elapsed:.1f}s, {n_written / max(elapsed, 1e-9):.2f} images/s")
+
+    if len(failed) > 0 or n_units < len(units):
+        print(f"{len(failed)} units failed, {len(units) - n_units} units were not processed")
+        for unit, error in failed:
+            print(f"  {'_'.join(unit)}: {error}")
+
+    if len(crashed) == n_processes:
+        raise RuntimeError("All relight workers exited unexpectedly")
+
+    return n_written
@@ -0,0 +1,107 @@
+import numpy as np
+import hashlib, os, tempfile
+from pathlib import Path
+
+
+class RelightCache:
+    """Content-addressed on-disk cache of .npz entries (preprocessed envmaps, light bases, OLAT envmap sets)
+    with least-recently-used eviction once the cache exceeds a size limit"""
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        """
+        Parameters
+        ----------
+        cache_dir : Path, str
+            directory to store the cache entries in (created if it does not exist)
+        max_bytes : int, optional
+            maximum total size of all entries, default: 2 GiB
+        """
+
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def file_hash(path, chunk_size=1024 * 1024):
+        """Returns the sha256 hex digest of the contents of the file at path"""
+
+        digest = hashlib.sha256()
+        with open(str(path), "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                digest.update(chunk)
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(*parts):
+        """Returns a cache key combining parts (hashes, options, other keys)"""
+
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return self.cache_dir / f"{key}.npz"
+
+    def load(self, key):
+        """Loads the entry for key
+
+        Parameters
+        ----------
+        key : str
+            key of the entry as returned by RelightCache.key
+
+        Returns
+        -------
+        entry : dict or None
+            arrays stored under key, None if there is no such entry
+        """
+
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as npz:
+                entry = {name: npz[name] for name in npz.files}
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+
+        try:
+            os.utime(path) # Mark as recently used
+        except FileNotFoundError:
+            pass # Evicted by another process after reading, the entry read is still valid
+
+        return entry
+
+    def save(self, key, **arrays):
+        """Stores arrays under key and evicts the least recently used entries if the cache is too large
+
+        Parameters
+        ----------
+        key : str
+            key of the entry as returned by RelightCache.key
+        arrays : np.array
+            named arrays to store
+        """
+
+        # Write to a temporary file first, so concurrent readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(tmp_path, self.entry_path(key))
+
+        self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits into max_bytes"""
+
+        entries = []
+        for path in self.cache_dir.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue # Removed by another process
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
@@ -0,0 +1,62 @@
+import numpy as np
+import cv2, io, json
+import urllib.request, urllib.error
+
+
+class RelightClient:
+    """Client for a local RelightServer"""
+
+    def __init__(self, host="127.0.0.1", port=8765, timeout=600.):
+        """
+        Parameters
+        ----------
+        host : str, optional
+            host of the server, default: "127.0.0.1"
+        port : int, optional
+            port of the server, default: 8765
+        timeout : float, optional
+            seconds to wait for a response, default: 600
+        """
+
+        self.url = f"http://{host}:{port}"
+        self.timeout = timeout
+
+    def relight(self, subject, pose, cam, envmap, scale=1.0, return_linear=False):
+        """Requests a relit image
+
+        Parameters
+        ----------
+        subject, pose, cam : str
+            OLAT stack to relight (e.g. "SUBJECT_C058", "POSE_00", "Cam01")
+        envmap : str
+            identifier of an envmap preloaded by the server or path to an envmap file readable by the server
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+        return_linear : bool, optional
+            return the linear float32 image instead of the 8-bit sRGB one, default: False
+
+        Returns
+        -------
+        relit_img : np.array
+            relit image (H, W, 3) in BGR order, linear float32 or sRGB with values in range 0 - 1
+        """
+
+        params = dict(subject=subject, pose=pose, cam=cam, envmap=str(envmap), scale=scale, format="npy" if return_linear else "png")
+        request = urllib.request.Request(f"{self.url}/relight", data=json.dumps(params).encode(),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                body = response.read()
+        except urllib.error.HTTPError as error:
+            raise RuntimeError(f"Relight request failed: {error.read().decode()}") from error
+
+        if return_linear:
+            return np.load(io.BytesIO(body))
+
+        return cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR).astype(np.float32) / 255.0
+
+    def metrics(self):
+        """Returns the metrics of the server as a dict"""
+
+        with urllib.request.urlopen(f"{self.url}/metrics", timeout=self.timeout) as response:
+            return json.loads(response.read())
@@ -0,0 +1,321 @@
+from olat_relight.olat_relight import OLATRelightWithEnvMap
+from olat_relight.relight_batch import read_relight_light_img, find_olat_paths
+from utils.avif_image_utils import linear_to_srgb8
+
+import numpy as np
+import cv2, io, json, time, threading
+from collections import OrderedDict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+
+class RelightRequest:
+    """A pending relight request, completed by the RelightServer dispatcher"""
+
+    def __init__(self, unit, envmap_id, scale):
+        self.unit = unit
+        self.envmap_id = envmap_id
+        self.scale = scale
+
+        self.start = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None # Linear relit image
+        self.error = None
+
+
+class RelightServer:
+    """Resident relight service. Keeps OLAT stacks of (subject, pose, camera) units warm in an LRU, coalesces
+    concurrent requests for the same stack into one multi-envmap relight and serves them over localhost HTTP.
+
+    Endpoints:
+    POST /relight with JSON {"subject", "pose", "cam", "envmap", "scale" (optional), "format" ("png" or "npy", optional)}
+        returns the relit image as 8-bit sRGB .png or linear float32 .npy. "envmap" is the identifier of a preloaded
+        envmap (file stem) or a path to an .exr readable by the server.
+    GET /metrics
+        returns queue depth, latency and batching statistics as JSON
+    """
+
+    def __init__(self, dataset_dir, path_to_olat_envmaps="./olat_relight/OLAT_EnvMaps", envmap_paths=(),
+                 max_stack_bytes=8 * 1024**3, max_batch=16, batch_window=0.005, dtype=np.uint8, use_mask=False,
+                 cache=None, image_dir="images_processed", max_adhoc_envmaps=16):
+        """
+        Parameters
+        ----------
+        dataset_dir : Path, str
+            path to the dataset root
+        path_to_olat_envmaps : Path, str, optional
+            directory containing the OLAT envmap .pngs, default: "./olat_relight/OLAT_EnvMaps"
+        envmap_paths : list of Path, str, optional
+            envmaps to preload, the file stem is used as identifier, default: ()
+        max_stack_bytes : int, optional
+            memory budget for resident OLAT stacks, least recently used stacks are evicted beyond it, default: 8 GiB
+        max_batch : int, optional
+            maximum number of requests relit in one pass over a stack, default: 16
+        batch_window : float, optional
+            seconds to wait for further requests before relighting, default: 0.005
+        dtype : np.dtype, optional
+            storage dtype of the OLATs, see OLATRelight.load_olats, default: np.uint8
+        use_mask : bool, optional
+            only relight the foreground given by the segmentation masks, default: False
+        cache : RelightCache, optional
+            on-disk cache for OLAT envmaps, envmaps and light bases, default: None
+        image_dir : str, optional
+            name of the image directory, default: "images_processed"
+        max_adhoc_envmaps : int, optional
+            number of envmaps loaded from request paths kept resident, least recently used ones beyond it are
+            dropped (preloaded envmaps are always kept), default: 16
+        """
+
+        self.dataset_dir = Path(dataset_dir)
+        self.max_stack_bytes = max_stack_bytes
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.dtype = dtype
+        self.use_mask = use_mask
+        self.image_dir = image_dir
+        self.max_adhoc_envmaps = max_adhoc_envmaps
+
+        self.relighter = OLATRelightWithEnvMap(path_to_olat_envmaps, cache=cache)
+        for envmap_path in envmap_paths:
+            self.load_envmap(Path(envmap_path).stem, envmap_path)
+
+        self.preloaded_envmaps = set(self.relighter.light_bases.keys())
+        self.adhoc_envmaps = OrderedDict() # Envmaps loaded from request paths in LRU order: envmap_id -> None
+
+        self.light_img = dict() # Per subject
+        self.stacks = OrderedDict() # Resident OLAT stacks in LRU order: olat_id -> nbytes
+
+        self.pending = OrderedDict() # olat_id -> list of RelightRequest, in order of the oldest request
+        self.condition = threading.Condition()
+
+        self.latencies = deque(maxlen=1000)
+        self.metrics = dict(requests=0, completed=0, failed=0, batches=0, stack_loads=0, stack_evictions=0, envmap_loads=0, envmap_evictions=0)
+
+        self.dispatcher = threading.Thread(target=self.dispatch_loop, daemon=True)
+        self.dispatcher.start()
+
+    def load_envmap(self, envmap_id, path_to_env):
+        """Loads an envmap and its basis, leaves no partial entry behind if either fails"""
+
+        # A failed earlier attempt may have left the envmap without a basis
+        self.drop_envmap(envmap_id)
+
+        try:
+            self.relighter.load_envmap(envmap_id, path_to_env)
+            self.relighter.ensure_base(envmap_id)
+        except Exception:
+            self.drop_envmap(envmap_id)
+            raise
+
+    def drop_envmap(self, envmap_id):
+        for envmap_dict in [self.relighter.env_maps, self.relighter.env_map_keys, self.relighter.light_bases]:
+            envmap_dict.pop(envmap_id, None)
+
+    def use_envmap(self, envmap_id):
+        """Makes the envmap of a request resident, loading it from its path if it is not loaded yet"""
+
+        if envmap_id in self.preloaded_envmaps:
+            return
+
+        if envmap_id not in self.relighter.light_bases.keys():
+            self.load_envmap(envmap_id, envmap_id)
+            with self.condition:
+                self.metrics["envmap_loads"] += 1
+
+        self.adhoc_envmaps[envmap_id] = None
+        self.adhoc_envmaps.move_to_end(envmap_id)
+
+    def evict_envmaps(self):
+        """Drops least recently used envmaps loaded from request paths beyond max_adhoc_envmaps"""
+
+        while len(self.adhoc_envmaps) > self.max_adhoc_envmaps:
+            envmap_id, _ = self.adhoc_envmaps.popitem(last=False)
+            self.drop_envmap(envmap_id)
+            with self.condition:
+                self.metrics["envmap_evictions"] += 1
+
+    def submit(self, unit, envmap, scale=1.0):
+        """Queues a relight request and waits for it
+
+        Parameters
+        ----------
+        unit : tuple
+            (subject, pose, cam) to relight
+        envmap : str
+            identifier of a loaded envmap or path to an envmap file
+        scale : float, optional
+            scale to apply (in linear space), default: 1.0
+
+        Returns
+        -------
+        relit_img : np.array
+            float32 linear relit image (H, W, 3)
+        """
+
+        request = RelightRequest(tuple(unit), envmap, scale)
+        olat_id = "_".join(request.unit)
+
+        with self.condition:
+            self.metrics["requests"] += 1
+            self.pending.setdefault(olat_id, []).append(request)
+            self.condition.notify()
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+        return request.result
+
+    def dispatch_loop(self):
+        while True:
+            with self.condition:
+                while len(self.pending) == 0:
+                    self.condition.wait()
+
+            # Give concurrent requests for the same stack the chance to arrive
+            time.sleep(self.batch_window)
+
+            with self.condition:
+                olat_id = next(iter(self.pending))
+                requests = self.pending[olat_id][:self.max_batch]
+                self.pending[olat_id] = self.pending[olat_id][self.max_batch:]
+                if len(self.pending[olat_id]) == 0:
+                    del self.pending[olat_id]
+                else:
+                    self.pending.move_to_end(olat_id)
+
+            self.process(olat_id, requests)
+
+    def process(self, olat_id, requests):
+        """Relights a batch of requests for the same OLAT stack in one pass"""
+
+        valid = []
+        for request in requests:
+            try:
+                self.use_envmap(request.envmap_id)
+                valid.append(request)
+            except Exception as error:
+                request.error = error
+
+        try:
+            if len(valid) > 0:
+                self.ensure_stack(olat_id, valid[0].unit)
+
+                light_bases = np.stack([request.scale * self.relighter.light_bases[request.envmap_id] for request in valid], axis=1)
+                relit_imgs = self.relighter.relight_with_bases(olat_id, light_bases, return_linear=True)
+
+                for request, relit_img in zip(valid, relit_imgs):
+                    request.result = relit_img
+        except Exception as error:
+            for request in valid:
+                request.error = error
+
+        # Only after the batch, so the envmaps of its requests stay loaded until they are relit
+        self.evict_envmaps()
+
+        now = time.perf_counter()
+        with self.condition:
+            self.metrics["batches"] += 1
+            for request in requests:
+                self.metrics["failed" if request.error is not None else "completed"] += 1
+                self.latencies.append(now - request.start)
+
+        for request in requests:
+            request.done.set()
+
+    def ensure_stack(self, olat_id, unit):
+        """Makes the OLAT stack of unit resident, evicting least recently used stacks beyond the memory budget"""
+
+        # The stack table is only changed by the dispatcher, but read by get_metrics from the HTTP threads
+        with self.condition:
+            if olat_id in self.stacks.keys():
+                self.stacks.move_to_end(olat_id)
+                return
+
+        subject, pose, cam = unit
+        if subject not in self.light_img.keys():
+            self.light_img[subject] = read_relight_light_img(self.dataset_dir, subject)
+
+        mask = self.dataset_dir / subject / pose / "segmentations" / "masks" / "000" / f"{cam}.png" if self.use_mask else None
+        self.relighter.load_olats(olat_id, find_olat_paths(self.dataset_dir, unit, self.light_img[subject], self.image_dir), dtype=self.dtype, mask=mask)
+
+        evicted_ids = []
+        with self.condition:
+            self.stacks[olat_id] = self.relighter.olat_tensors[olat_id].nbytes
+            self.metrics["stack_loads"] += 1
+
+            while sum(self.stacks.values()) > self.max_stack_bytes and len(self.stacks) > 1:
+                evicted_id, _ = self.stacks.popitem(last=False)
+                evicted_ids.append(evicted_id)
+                self.metrics["stack_evictions"] += 1
+
+        for evicted_id in evicted_ids:
+            self.relighter.unload_olats(evicted_id)
+
+    def get_metrics(self):
+        """Returns the current service metrics as a dict"""
+
+        with self.condition:
+            latencies = np.array(self.latencies)
+            metrics = dict(self.metrics)
+            metrics["queue_depth"] = sum(len(requests) for requests in self.pending.values())
+            metrics["resident_stacks"] = len(self.stacks)
+            metrics["resident_bytes"] = sum(self.stacks.values())
+            metrics["resident_adhoc_envmaps"] = len(self.adhoc_envmaps)
+        metrics["mean_batch_size"] = (metrics["completed"] + metrics["failed"]) / max(metrics["batches"], 1)
+
+        if len(latencies) > 0:
+            metrics["latency_mean"] = float(latencies.mean())
+            metrics["latency_p50"] = float(np.percentile(latencies, 50))
+            metrics["latency_p95"] = float(np.percentile(latencies, 95))
+
+        return metrics
+
+    def serve(self, host="127.0.0.1", port=8765):
+        """Serves requests over HTTP until interrupted"""
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_body(self, code, body, content_type):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    return self.send_body(404, b"Not found", "text/plain")
+                self.send_body(200, json.dumps(server.get_metrics()).encode(), "application/json")
+
+            def do_POST(self):
+                if self.path != "/relight":
+                    return self.send_body(404, b"Not found", "text/plain")
+
+                try:
+                    params = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                    unit = (params["subject"], params["pose"], params["cam"])
+                    relit_img = server.submit(unit, params["envmap"], float(params.get("scale", 1.0)))
+                except Exception as error:
+                    return self.send_body(400, str(error).encode(), "text/plain")
+
+                if params.get("format", "png") == "npy":
+                    buffer = io.BytesIO()
+                    np.save(buffer, relit_img)
+                    return self.send_body(200, buffer.getvalue(), "application/octet-stream")
+
+                _, png = cv2.imencode(".png", linear_to_srgb8(relit_img))
+                self.send_body(200, png.tobytes(), "image/png")
+
+            def log_message(self, format, *args):
+                pass # Metrics replace per-request logging
+
+        http_server = ThreadingHTTPServer((host, port), Handler)
+        print(f"Serving relight requests at http://{host}:{port}")
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
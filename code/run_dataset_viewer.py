@@ -2,6 +2,7 @@ import os
 from pathlib import Path
 
 from visualize.olat_explorer import *
+from utils.dataset_manifest import build_manifest
 import argparse
 
 def parse_args():
@@ -14,6 +15,8 @@ def parse_args():
         default="images_processed",
         help='Name of the image directory to use (default: "images_processed")'
     )
+    parser.add_argument("--manifest", type=str, default=None, help="Manifest file to reuse across runs (refreshed incrementally), default: scan without storing")
+    parser.add_argument("--downscale", type=int, default=2, help="Factor to load and display images at reduced resolution (default: 2)")
     return parser.parse_args()
 
 
@@ -22,32 +25,37 @@ if __name__ == "__main__":
     args = parse_args()
 
     MAIN_PATH = Path(args.path)
+
+    # Index the dataset once instead of listing directories per subject, pose and camera
+    manifest = build_manifest(MAIN_PATH, args.manifest, image_dirs=(args.image_dir,), subjects=[args.subject_name] if args.subject_name != "" else None)
+
     subjects = [args.subject_name]
     if args.subject_name == "":
-        subjects = sorted(os.listdir(MAIN_PATH))
+        subjects = manifest.subjects()
 
-    explorer = OLATExplorer()
+    # Images are decoded at reduced resolution directly, so the explorer does not need to scale them for display
+    explorer = OLATExplorer(display_downscale=1)
 
     # Loading of takes can be adjusted freely
 
     for subject in subjects:
         print(f"Loading subject {subject}")
-        for i in range(len(os.listdir(MAIN_PATH / subject ))-1):
-            pose_name = f"POSE_{i:02}"
+        for pose_name in manifest.poses(subject):
             take_id = subject + "_" + pose_name
             take = Take(take_id)
 
-            for cam in range(1, 41):
-                image_path_dir = MAIN_PATH / subject / pose_name / args.image_dir / f"Cam{cam:02}"
-                sequence = ImageSequence(take_id+f"_Cam{cam:02}", image_path_dir)
+            for cam in manifest.cams(subject, pose_name, args.image_dir):
+                image_path_dir = MAIN_PATH / subject / pose_name / args.image_dir / cam
+                sequence = ImageSequence(take_id+f"_{cam}", image_path_dir, downscale=args.downscale,
+                                         image_paths=manifest.frames(subject, pose_name, cam, args.image_dir))
                 take.add_cameras([sequence])
 
             take.add_pyrender_scene(
                 mesh_path=MAIN_PATH / subject / pose_name / "model" / "model.obj",
                 texture_path=MAIN_PATH / subject / pose_name / "model" / "model.jpeg",
-                calib_folder=MAIN_PATH / subject / "shared",
-                lights_pos_path=MAIN_PATH / subject / "shared" / "LSX_light_positions_aligned.pc",
-                lights_seq_path=MAIN_PATH / subject  / "shared" / "LSX3_light_z_spiral.txt"
+                calib_folder=manifest.shared_path(subject, "calib_dir"),
+                lights_pos_path=manifest.shared_path(subject, "light_positions"),
+                lights_seq_path=manifest.shared_path(subject, "light_order")
             )
 
             explorer.add_take(take)
@@ -0,0 +1,44 @@
+from pathlib import Path
+import argparse
+import numpy as np
+
+from olat_relight.relight_batch import find_relight_units, run_relight_batch
+
+
+# Batch OLAT relighting of many subjects/poses/cameras under many envmaps
+# Example: python run_olat_relight_batch.py /PATH/TO/YOUR/FinalData --subjects SUBJECT_C058 --processes 2
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Relight HumanOLAT captures under a set of envmaps.")
+    parser.add_argument("path", type=str, help="Path to the dataset")
+    parser.add_argument("--out", type=str, default="./out/olat_relight_batch", help="Output directory, images are written to OUT/SUBJECT/POSE/CAM/ENVMAP.EXT")
+    parser.add_argument("--envmaps", type=str, nargs="+", default=None, help="Paths to .exr envmaps (default: all in ./olat_relight/example_envmaps)")
+    parser.add_argument("--subjects", type=str, nargs="+", default=None, help="Subjects to relight (default: all)")
+    parser.add_argument("--poses", type=str, nargs="+", default=None, help="Poses to relight (default: all)")
+    parser.add_argument("--cams", type=str, nargs="+", default=None, help="Cameras to relight, e.g. Cam01 (default: all)")
+    parser.add_argument("--ext", type=str, default=".png", choices=[".png", ".exr"], help="Output format: 8-bit sRGB .png or linear .exr")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale to apply in linear space")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--envmap_batch", type=int, default=8, help="Number of envmaps relit in one pass over the OLATs")
+    parser.add_argument("--dtype", type=str, default="uint8", choices=["uint8", "float16", "float32"], help="Storage dtype of the OLATs in memory")
+    parser.add_argument("--use_mask", action="store_true", help="Only relight the foreground given by the segmentation masks")
+    parser.add_argument("--cache", type=str, default=None, help="Directory for caching OLAT envmaps, envmaps and light bases")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    envmap_paths = args.envmaps
+    if envmap_paths is None:
+        envmap_paths = sorted(Path("./olat_relight/example_envmaps").glob("*.exr"))
+
+    units = find_relight_units(args.path, subjects=args.subjects, poses=args.poses, cams=args.cams)
+    print(f"Relighting {len(units)} (subject, pose, camera) units under {len(envmap_paths)} envmaps with {args.processes} processes")
+
+    run_relight_batch(
+        units, n_processes=args.processes,
+        dataset_dir=args.path, out_dir=args.out, envmap_paths=[str(p) for p in envmap_paths],
+        out_ext=args.ext, scale=args.scale, envmap_batch=args.envmap_batch,
+        dtype=np.dtype(args.dtype), use_mask=args.use_mask, cache_dir=args.cache
+    )
@@ -0,0 +1,69 @@
+import time, resource
+import multiprocessing as mp
+import numpy as np
+
+from olat_relight.olat_relight import contract_olats
+
+
+# Benchmark for OLAT relighting: compares the broadcasted multiply-reduce with the banded contraction
+# Every method runs in a fresh process, so peak RSS values are comparable
+
+# ---------------------------------------------------------
+
+###########################
+# ADJUST THESE PARAMETERS #
+###########################
+
+N_LIGHTS = 331 # Number of OLATs
+IMAGE_H, IMAGE_W = 1024, 1024 # Resolution of the synthetic OLATs
+N_REPEATS = 3 # Number of timed relights per method
+
+# ---------------------------------------------------------
+
+
+def relight_broadcast(olat_tensor, light_basis):
+    return np.sum(light_basis[:, None, None, :] * olat_tensor, axis=0)
+
+
+def relight_contract(olat_tensor, light_basis):
+    return contract_olats(olat_tensor, light_basis)
+
+
+def run_method(method, queue):
+    rng = np.random.default_rng(0)
+    olat_tensor = rng.random((N_LIGHTS, IMAGE_H, IMAGE_W, 3), dtype=np.float32)
+    light_basis = rng.random((N_LIGHTS, 3), dtype=np.float32) / N_LIGHTS
+    rss_data = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    times = []
+    for _ in range(N_REPEATS):
+        start = time.perf_counter()
+        relit_img = method(olat_tensor, light_basis)
+        times.append(time.perf_counter() - start)
+
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((min(times), rss_data, rss_peak, relit_img[::64, ::64].astype(np.float32)))
+
+
+def benchmark(method):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_method, args=(method, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    print(f"Relighting {N_LIGHTS} OLATs at {IMAGE_W}x{IMAGE_H}, OLAT data: {N_LIGHTS * IMAGE_H * IMAGE_W * 3 * 4 / 2**30:.2f} GiB")
+
+    results = dict()
+    for name, method in [("broadcast", relight_broadcast), ("contract", relight_contract)]:
+        results[name] = benchmark(method)
+        t, rss_data, rss_peak, _ = results[name]
+        # ru_maxrss is reported in KiB on Linux
+        print(f"{name:>10}: {t:.3f}s per relight, peak RSS {rss_peak / 2**20:.2f} GiB ({(rss_peak - rss_data) / 2**20:.2f} GiB above OLAT data)")
+
+    max_err = np.abs(results["broadcast"][3] - results["contract"][3]).max()
+    print(f"Speedup: {results['broadcast'][0] / results['contract'][0]:.2f}x, max abs difference: {max_err:.2e}")
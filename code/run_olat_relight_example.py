@@ -19,6 +19,9 @@ POSE = "POSE_00" # Name of pose to process
 CAM = "Cam01" # Name of camera to process
 
 OUT_PATH = Path("./out/olat_relight") # Where to write the .ply and json files
+USE_MASK = False # Only store and relight the foreground pixels given by the segmentation mask of the camera
+OLAT_STORE_PATH = None # Optional .npy file to export the linear OLATs to once and memory-map on later runs
+CACHE_PATH = None # Optional directory for caching OLAT envmaps, preprocessed envmaps and light bases across runs
 
 # ---------------------------------------------------------
 
@@ -37,7 +40,8 @@ light_positions, light_img = read_OLAT_info(lights_pos_path,lights_sort_path, OL
 OUT_PATH.mkdir(parents=True, exist_ok=True)
 
 print("Building OLAT relighter ...")
-olat_relighter = OLATRelightWithEnvMap("./olat_relight/OLAT_EnvMaps")
+cache = RelightCache(CACHE_PATH) if CACHE_PATH is not None else None
+olat_relighter = OLATRelightWithEnvMap("./olat_relight/OLAT_EnvMaps", cache=cache)
 
 # Load OLATs
 print("Loading OLATs ...")
@@ -45,7 +49,9 @@ olat_id = f"{SUBJECT}_{POSE}_{CAM}"
 olat_paths = sorted(Path(PATH_TO_DATASET / SUBJECT / POSE / "images_processed" / CAM).glob(f"*.avif"))
 olat_paths_filtered = list([olat_paths[i] for i in light_img])
 
-olat_relighter.load_olats(olat_id, olat_paths_filtered)
+mask_path = PATH_TO_DATASET / SUBJECT / POSE / "segmentations" / "masks" / "000" / f"{CAM}.png"
+
+olat_relighter.load_olats(olat_id, olat_paths_filtered, olat_store=OLAT_STORE_PATH, mask=mask_path if USE_MASK else None)
 
 # Load envmap
 print("Loading EnvMap ...")
@@ -0,0 +1,33 @@
+import argparse
+
+from utils.packed_dataset import pack_dataset, verify_packed_dataset
+
+
+# Packs the camera directories of the processed dataset into shards for fast access, see utils/packed_dataset.py
+# Example: python run_pack_dataset.py /PATH/TO/YOUR/FinalData /PATH/TO/PACKED --subjects SUBJECT_C058 --verify
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pack HumanOLAT images into per-camera shards.")
+    parser.add_argument("path", type=str, help="Path to the dataset")
+    parser.add_argument("out", type=str, help="Output directory of the packed dataset")
+    parser.add_argument("--subjects", type=str, nargs="+", default=None, help="Subjects to pack (default: all)")
+    parser.add_argument("--poses", type=str, nargs="+", default=None, help="Poses to pack (default: all)")
+    parser.add_argument("--image_dir", type=str, default="images_processed", help='Name of the image directory to pack (default: "images_processed")')
+    parser.add_argument("--chunk_size", type=int, default=32, help="Number of frames read at once from a shard")
+    parser.add_argument("--workers", type=int, default=8, help="Number of camera directories packed in parallel")
+    parser.add_argument("--verify", action="store_true", help="Verify the packed dataset byte by byte against the source images after packing")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    n_frames = pack_dataset(args.path, args.out, subjects=args.subjects, poses=args.poses, image_dir=args.image_dir,
+                            chunk_size=args.chunk_size, workers=args.workers)
+    print(f"Packed {n_frames} frames (existing shards were skipped)")
+
+    if args.verify:
+        errors = verify_packed_dataset(args.path, args.out, subjects=args.subjects, poses=args.poses, image_dir=args.image_dir, workers=args.workers)
+        for error in errors:
+            print(error)
+        print(f"Verification {'failed with ' + str(len(errors)) + ' errors' if errors else 'passed'}")
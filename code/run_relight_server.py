@@ -0,0 +1,40 @@
+from pathlib import Path
+import argparse
+import numpy as np
+
+from olat_relight.relight_server import RelightServer
+from olat_relight.relight_cache import RelightCache
+
+
+# Resident relight service, query it with olat_relight.relight_client.RelightClient
+# Example: python run_relight_server.py /PATH/TO/YOUR/FinalData --max_stack_gb 16
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve OLAT relighting requests over localhost HTTP.")
+    parser.add_argument("path", type=str, help="Path to the dataset")
+    parser.add_argument("--envmaps", type=str, nargs="+", default=None, help="Paths to .exr envmaps to preload (default: all in ./olat_relight/example_envmaps)")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--max_stack_gb", type=float, default=8.0, help="Memory budget for resident OLAT stacks in GiB")
+    parser.add_argument("--max_batch", type=int, default=16, help="Maximum number of requests relit in one pass over a stack")
+    parser.add_argument("--dtype", type=str, default="uint8", choices=["uint8", "float16", "float32"], help="Storage dtype of the OLATs in memory")
+    parser.add_argument("--use_mask", action="store_true", help="Only relight the foreground given by the segmentation masks")
+    parser.add_argument("--cache", type=str, default=None, help="Directory for caching OLAT envmaps, envmaps and light bases")
+    parser.add_argument("--max_adhoc_envmaps", type=int, default=16, help="Number of envmaps loaded from request paths kept in memory")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    envmap_paths = args.envmaps
+    if envmap_paths is None:
+        envmap_paths = sorted(Path("./olat_relight/example_envmaps").glob("*.exr"))
+
+    server = RelightServer(
+        args.path, envmap_paths=envmap_paths,
+        max_stack_bytes=int(args.max_stack_gb * 1024**3), max_batch=args.max_batch,
+        dtype=np.dtype(args.dtype), use_mask=args.use_mask,
+        cache=RelightCache(args.cache) if args.cache is not None else None, max_adhoc_envmaps=args.max_adhoc_envmaps
+    )
+    server.serve(args.host, args.port)
@@ -0,0 +1,44 @@
+import argparse, time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from olat_relight.relight_client import RelightClient
+
+
+# Load test for a running relight server (see run_relight_server.py)
+# Example: python run_relight_server_loadtest.py --units SUBJECT_C058/POSE_00/Cam01 --envmaps class pisa --clients 8
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test a running relight server.")
+    parser.add_argument("--units", type=str, nargs="+", required=True, help="OLAT stacks to request as SUBJECT/POSE/CAM")
+    parser.add_argument("--envmaps", type=str, nargs="+", required=True, help="Envmap identifiers or paths to request")
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="Total number of requests")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host of the server")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the server")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random request order")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    client = RelightClient(args.host, args.port)
+    rng = np.random.default_rng(args.seed)
+    units = [unit.split("/") for unit in args.units]
+    requests = [(units[rng.integers(len(units))], args.envmaps[rng.integers(len(args.envmaps))]) for _ in range(args.requests)]
+
+    def send(request):
+        unit, envmap = request
+        start = time.perf_counter()
+        client.relight(*unit, envmap)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        latencies = np.array(list(pool.map(send, requests)))
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(requests)} requests with {args.clients} clients in {elapsed:.2f}s, {len(requests) / elapsed:.2f} requests/s")
+    print(f"Latency mean {latencies.mean():.3f}s, p50 {np.percentile(latencies, 50):.3f}s, p95 {np.percentile(latencies, 95):.3f}s, max {latencies.max():.3f}s")
+    print(f"Server metrics: {client.metrics()}")
@@ -1,10 +1,8 @@
 from utils.metadata_readers import *
 from utils.avif_image_utils import load_image_np
+from utils.dataset_manifest import read_image_size
 
-import scipy.ndimage
 import pywavefront
-import random
-from plyfile import PlyData, PlyElement
 
 import os, sys
 import numpy as np
@@ -17,9 +15,12 @@ import json
 
 # .ply point cloud writing
 
-def storePly(path, xyz, rgb, norms):
-    """ Stores a pointcloud with positions, color and normals
-    Adapted from gaussian splatting code
+# PLY property types of numpy dtypes
+PLY_TYPES = {'i1': 'char', 'u1': 'uchar', 'i2': 'short', 'u2': 'ushort', 'i4': 'int', 'u4': 'uint', 'f4': 'float', 'f8': 'double'}
+
+def storePly(path, xyz, rgb, norms, extra_attributes=None, chunk_size=1_000_000):
+    """ Stores a pointcloud with positions, color and normals as binary little-endian .ply
+    Adapted from gaussian splatting code. Points are written in chunks, column by column.
 
     Parameters
     ----------
@@ -28,30 +29,57 @@ def storePly(path, xyz, rgb, norms):
     xyz : np.array
         positions (N, 3)
     rgb : np.array
-        colors (N, 3)
+        colors (N, 3), stored as uchar
     norms : np.array
         normals (N, 3)
+    extra_attributes : dict, optional
+        further per-point attributes {name: (N,) or (N, K) array} (e.g. per-light colors), stored with their dtype.
+        (N, K) attributes are stored as properties name_0 ... name_{K-1}. Default: None
+    chunk_size : int, optional
+        number of points written at once, default: 1_000_000
     """
 
     path = str(path)
     print(f"Storing PLY file at: {path}")
     print(f"XYZ shape: {xyz.shape}, RGB shape: {rgb.shape}, Normals shape: {norms.shape}")
-    
-    dtype = [('x', 'f4'), ('y', 'f4'), ('z', 'f4'),
-             ('nx', 'f4'), ('ny', 'f4'), ('nz', 'f4'),
-             ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
-    
-    normals = norms
 
-    elements = np.empty(xyz.shape[0], dtype=dtype)
-    attributes = np.concatenate((xyz, normals, rgb), axis=1)
-    elements[:] = list(map(tuple, attributes))
+    N_POINTS = xyz.shape[0]
+
+    # (property name, source column, dtype)
+    columns = [(name, xyz[:, i], 'f4') for i, name in enumerate(['x', 'y', 'z'])]
+    columns += [(name, norms[:, i], 'f4') for i, name in enumerate(['nx', 'ny', 'nz'])]
+    columns += [(name, rgb[:, i], 'u1') for i, name in enumerate(['red', 'green', 'blue'])]
+
+    for name, values in (extra_attributes or dict()).items():
+        values = np.asarray(values)
+        assert len(values) == N_POINTS, f"Attribute {name} has {len(values)} values for {N_POINTS} points"
+        assert values.dtype.str[1:] in PLY_TYPES.keys(), f"Unsupported dtype {values.dtype} of attribute {name}"
+
+        if values.ndim == 1:
+            columns.append((name, values, values.dtype.str[1:]))
+        else:
+            columns += [(f"{name}_{k}", values[:, k], values.dtype.str[1:]) for k in range(values.shape[1])]
+
+    dtype = np.dtype([(name, '<' + type_str) for name, _, type_str in columns])
+
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {N_POINTS}"]
+    header += [f"property {PLY_TYPES[type_str]} {name}" for name, _, type_str in columns]
+    header += ["end_header"]
+
+    with open(path, "wb") as file:
+        file.write(("\n".join(header) + "\n").encode("ascii"))
+
+        elements = np.empty(min(chunk_size, N_POINTS), dtype=dtype)
+        for start in range(0, N_POINTS, chunk_size):
+            stop = min(start + chunk_size, N_POINTS)
+            chunk = elements[:stop - start]
 
-    vertex_element = PlyElement.describe(elements, 'vertex')
-    ply_data = PlyData([vertex_element])
-    ply_data.write(path)
+            for name, values, _ in columns:
+                chunk[name] = values[start:stop]
 
-def sampleMesh_UNIFORM(mesh, n_samples, texture_img):
+            file.write(chunk.tobytes())
+
+def sampleMesh_UNIFORM(mesh, n_samples, texture_img, seed=None, chunk_size=250_000):
     """ Uniformly samples a pywavefront mesh. See generate_point_cloud(...) for use
 
     Parameters
@@ -61,7 +89,20 @@ def sampleMesh_UNIFORM(mesh, n_samples, texture_img):
     n_samples : int
         number of samples to take
     texture_img : np.array
-        texture image
+        texture image (BGR, as read by cv2)
+    seed : int, optional
+        seed of the random generator, the same seed (and chunk_size) gives the same point cloud, default: None (random)
+    chunk_size : int, optional
+        number of samples drawn at once, bounds the size of intermediate arrays, default: 250_000
+
+    Returns
+    -------
+    xyzs : np.array
+        sampled positions (n_samples, 3)
+    rgbs : np.array
+        uint8 RGB colors, bilinearly interpolated from the texture (n_samples, 3)
+    norms : np.array
+        interpolated normals (n_samples, 3)
     """
 
     print(f"Sampling mesh uniformly with {n_samples} samples.")
@@ -78,38 +119,54 @@ def sampleMesh_UNIFORM(mesh, n_samples, texture_img):
     print(f"Face data shape: {face_data.shape}")
     
     face_num, primitive_corner_num, vert_size = face_data.shape
-    face_areas = area(face_data)
 
-    prob_dist = face_areas / sum(face_areas)
-    samples = np.array(random.choices(range(face_num), k=n_samples, weights=prob_dist))
-    face_data = face_data[samples]
+    # Faces are drawn by area through binary search in the cumulative areas
+    cum_areas = np.cumsum(area(face_data))
+    rng = np.random.default_rng(seed)
 
-    r_triangle = np.random.random_sample((n_samples, 2))
-    r_triangle[:, 0] = np.sqrt(r_triangle[:, 0])
-    vertex_weights = np.stack((1 - r_triangle[:, 0], r_triangle[:, 0] * (1 - r_triangle[:, 1]), r_triangle[:, 0] * r_triangle[:, 1]), axis=-1) 
+    tex_height, tex_width, _ = texture_img.shape
+    print(f"Texture image shape: {texture_img.shape}")
+    texels = np.ascontiguousarray(texture_img[..., ::-1]).reshape(-1, 3) # BGR -> RGB, one row per texel
 
-    aggregated_data = np.sum(vertex_weights[:, :, None] * face_data, axis=1)
+    xyzs = np.empty((n_samples, 3))
+    norms = np.empty((n_samples, 3))
+    rgbs = np.empty((n_samples, 3), dtype=np.uint8)
 
-    tex_coords = aggregated_data[:, :2]
-    norms = aggregated_data[:, 2:5]
-    xyzs = aggregated_data[:, 5:]
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
 
-    tex_height, tex_width, _ = texture_img.shape
-    print(f"Texture image shape: {texture_img.shape}")
+        samples = np.searchsorted(cum_areas, rng.random(stop - start) * cum_areas[-1], side='right')
+        samples = np.minimum(samples, face_num - 1)
+
+        r_triangle = rng.random((stop - start, 2))
+        r_triangle[:, 0] = np.sqrt(r_triangle[:, 0])
+        vertex_weights = np.stack((1 - r_triangle[:, 0], r_triangle[:, 0] * (1 - r_triangle[:, 1]), r_triangle[:, 0] * r_triangle[:, 1]), axis=-1) 
+
+        aggregated_data = np.einsum('nc,ncd->nd', vertex_weights, face_data[samples])
+
+        norms[start:stop] = aggregated_data[:, 2:5]
+        xyzs[start:stop] = aggregated_data[:, 5:]
+
+        # Texel coordinates (row, col) with v flipped, clamped to the texture
+        rows = np.clip((1 - aggregated_data[:, 1]) * tex_height, 0, tex_height - 1)
+        cols = np.clip(aggregated_data[:, 0] * tex_width, 0, tex_width - 1)
 
-    tex_coords[:, 1] = 1 - tex_coords[:, 1]
-    tex_coords[:, 0] *= tex_width
-    tex_coords[:, 1] *= tex_height
-    tex_coords = tex_coords[:, ::-1]
+        row0 = np.minimum(rows.astype(np.int64), tex_height - 2) if tex_height > 1 else np.zeros(len(rows), dtype=np.int64)
+        col0 = np.minimum(cols.astype(np.int64), tex_width - 2) if tex_width > 1 else np.zeros(len(cols), dtype=np.int64)
+        row1 = np.minimum(row0 + 1, tex_height - 1)
+        col1 = np.minimum(col0 + 1, tex_width - 1)
+        dr = (rows - row0)[:, None]
+        dc = (cols - col0)[:, None]
 
-    rgbs = np.stack((scipy.ndimage.map_coordinates(texture_img[..., 2], tex_coords.T),
-                     scipy.ndimage.map_coordinates(texture_img[..., 1], tex_coords.T),
-                     scipy.ndimage.map_coordinates(texture_img[..., 0], tex_coords.T))).T
+        # Bilinear interpolation of all channels at once
+        top = (1 - dc) * texels[row0 * tex_width + col0] + dc * texels[row0 * tex_width + col1]
+        bottom = (1 - dc) * texels[row1 * tex_width + col0] + dc * texels[row1 * tex_width + col1]
+        rgbs[start:stop] = np.clip(np.rint((1 - dr) * top + dr * bottom), 0, 255)
 
     print(f"Sampled XYZs shape: {xyzs.shape}, RGBs shape: {rgbs.shape}, Normals shape: {norms.shape}")
     return xyzs, rgbs, norms
 
-def generate_point_cloud(model_dir, target_dir, n_samples = 300_000, out_name="points3d.ply", scale_to_m=True):
+def generate_point_cloud(model_dir, target_dir, n_samples = 300_000, out_name="points3d.ply", scale_to_m=True, seed=None):
     """ Generates a pointcloud .ply for the "model.obj" found in model_dir
 
     Parameters
@@ -124,6 +181,8 @@ def generate_point_cloud(model_dir, target_dir, n_samples = 300_000, out_name="p
         name of the final .ply
     scale_to_m : bool
         scale the pointcloud to meters. If false, point cloud will be in millimeters
+    seed : int, optional
+        seed of the sampling, the same seed gives the same point cloud, default: None (random)
     """
     
     model_dir = Path(model_dir)
@@ -137,22 +196,23 @@ def generate_point_cloud(model_dir, target_dir, n_samples = 300_000, out_name="p
 
     scale = 1000. if scale_to_m else 1.
 
-    xyzs, rgbs, norms = sampleMesh_UNIFORM(mesh, n_samples, texture_img)
+    xyzs, rgbs, norms = sampleMesh_UNIFORM(mesh, n_samples, texture_img, seed=seed)
     storePly(str(target_dir / out_name), xyzs / scale, rgbs, norms)
 
 # camera json writing
 
 def get_image_shape(image_path):
     print(f"Getting image shape for: {image_path}")
-    im = load_image_np(str(image_path))	
-    print(f"Image shape: {im.shape}")
-    return im.shape
+    W, H = read_image_size(image_path) # Reads the header only
+    shape = (H, W, 3)
+    print(f"Image shape: {shape}")
+    return shape
 
 
 def generate_cam_jsons(dataset_dir, subject_pose, out_dir,
                         name, cams_to_include, lights_to_include,
                         light_positions, light_img,
-                        scale_to_m=True, img_ext=".avif"):
+                        scale_to_m=True, img_ext=".avif", manifest=None):
     """ Writes a .json in NeRF format (for OLAT images)
 
     Parameters
@@ -180,6 +240,9 @@ def generate_cam_jsons(dataset_dir, subject_pose, out_dir,
         scale the transforms to meters. If false, transforms will be in millimeters. Default: True
     img_ext : str, optional
         image extension to detect, Default: True
+    manifest : DatasetManifest, optional
+        manifest of the dataset (see utils.dataset_manifest.build_manifest) to take frame lists and image sizes from
+        instead of listing directories, Default: None
     """
 
     dataset_dir = Path(dataset_dir)
@@ -190,12 +253,14 @@ def generate_cam_jsons(dataset_dir, subject_pose, out_dir,
 
     print(f"Generating camera {name} JSONs for at subject {subject}, pose {pose} at {dataset_dir}")
 
-    imgs_path = dataset_dir / subject / pose / "images_processed"
-    _, IMAGE_W, _ = get_image_shape(list(sorted((dataset_dir / subject / pose / "images_processed" /  "Cam01").glob(f'*{img_ext}')))[0])
+    if manifest is not None:
+        IMAGE_W, _ = manifest.image_size(subject, pose, "Cam01")
+    else:
+        _, IMAGE_W, _ = get_image_shape(list(sorted((dataset_dir / subject / pose / "images_processed" /  "Cam01").glob(f'*{img_ext}')))[0])
 
     print(f"Loading intrinsics for image width: {IMAGE_W}")    
-    intr, extr = [], []
-    read_calib(str(dataset_dir / subject / "shared"), IMAGE_W, intr, extr, scale_to_meters=scale_to_m, invert_extr=False) # Gets c2w extrinsics
+    rig = load_camera_rig(dataset_dir / subject / "shared", IMAGE_W, scale_to_meters=scale_to_m)
+    intr, extr = rig.intrinsics, rig.c2w # c2w extrinsics
     
     
     nerf_json = dict()
@@ -205,7 +270,10 @@ def generate_cam_jsons(dataset_dir, subject_pose, out_dir,
         print(f"Processing camera: {cam}")
         CAM_PATH = dataset_dir / subject / pose / "images_processed" / f"Cam{cam+1:>02}"
 
-        IMGS = list(sorted(CAM_PATH.glob(f'*{img_ext}')))
+        if manifest is not None:
+            IMGS = manifest.frames(subject, pose, f"Cam{cam+1:>02}")
+        else:
+            IMGS = list(sorted(CAM_PATH.glob(f'*{img_ext}')))
         print(f"Found {len(IMGS)} images for camera {cam}")
 
         for light in tqdm(lights_to_include):
@@ -1,8 +1,12 @@
 from PIL import Image
 import pillow_avif # Depending on your python version, this may already be included in PIL
+from utils.metadata_readers import load_camera_rig
+from utils.packed_dataset import PackedFrame
 import numpy as np
-import cv2, os
+import cv2, os, hashlib, tempfile
 import torch
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
 # Needed to allow loading .exr
 os.environ["OPENCV_IO_ENABLE_OPENEXR"]="1"
@@ -84,18 +88,185 @@ def linear_to_srgb(linear, gamma=2.4):
     raise Exception(f"Expected numpy or torch array, but got {type(linear)}.") 
         
 
+# Lookup tables, built once per gamma (and size) and shared read-only
+_SRGB8_TO_LINEAR_LUTS = dict()
+_LINEAR_TO_SRGB8_LUTS = dict()
+
+
+def srgb8_to_linear_lut(gamma=2.4):
+    """ Lookup table decoding 8-bit sRGB codes to linear values, i.e. lut[code] = sRGB_to_linear(code / 255)
+
+    Parameters
+    ----------
+    gamma : float
+        gamma to use for decoding
+
+    Returns
+    -------
+    lut : np.array
+        (256,) read-only float32 linear values with range 0 - 1
+    """
+
+    if gamma not in _SRGB8_TO_LINEAR_LUTS.keys():
+        lut = sRGB_to_linear(np.arange(256, dtype=np.float32) / np.float32(255.0), gamma=gamma).astype(np.float32)
+        lut.flags.writeable = False
+        _SRGB8_TO_LINEAR_LUTS[gamma] = lut
+
+    return _SRGB8_TO_LINEAR_LUTS[gamma]
+
+
+def linear_to_srgb8_lut(size=4096, gamma=2.4):
+    """ Lookup table encoding linear values to 8-bit sRGB codes, i.e. lut[i] = round(255 * linear_to_srgb(i / (size - 1)))
+
+    Parameters
+    ----------
+    size : int
+        number of uniformly spaced linear samples in range 0 - 1 (at most 65536)
+    gamma : float
+        gamma to use for encoding
+
+    Returns
+    -------
+    lut : np.array
+        (size,) read-only uint8 sRGB codes
+    """
+
+    assert 2 <= size <= 65536, f"Unsupported table size {size}"
+
+    if (size, gamma) not in _LINEAR_TO_SRGB8_LUTS.keys():
+        lut = np.rint(255 * linear_to_srgb(np.linspace(0, 1, size), gamma=gamma)).astype(np.uint8)
+        lut.flags.writeable = False
+        _LINEAR_TO_SRGB8_LUTS[(size, gamma)] = lut
+
+    return _LINEAR_TO_SRGB8_LUTS[(size, gamma)]
+
+
+def srgb8_to_linear(srgb8, gamma=2.4):
+    """ Conversion from 8-bit sRGB codes to linear RGB through a 256 entry lookup table.
+    Gives the same values as sRGB_to_linear(srgb8 / 255) without evaluating the transfer function per pixel.
+
+    Parameters
+    ----------
+    srgb8 : np.array
+        numpy or torch uint8 sRGB image
+    gamma : float
+        gamma to use for decoding
+
+    Returns
+    -------
+    linear : np.array
+        numpy or torch float32 linear image with values in range 0 - 1
+    """
+
+    lut = srgb8_to_linear_lut(gamma)
+
+    if isinstance(srgb8, np.ndarray):
+        assert srgb8.dtype == np.uint8, f"Expected uint8 codes, but got {srgb8.dtype}"
+        return lut[srgb8]
+
+    if torch.is_tensor(srgb8):
+        assert srgb8.dtype == torch.uint8, f"Expected uint8 codes, but got {srgb8.dtype}"
+        return torch.from_numpy(lut.copy()).to(srgb8.device)[srgb8.long()]
+
+    raise Exception(f"Expected numpy or torch array, but got {type(srgb8)}.")
+
+
+def linear_to_srgb8(linear, gamma=2.4, lut_size=4096, out=None):
+    """ Quantizing conversion from linear RGB to 8-bit sRGB codes through a lookup table, e.g. for writing images.
+    The linear values are rounded to the nearest of lut_size samples, for the default size the codes differ by at
+    most one from round(255 * linear_to_srgb(linear)) (the sRGB curve has a slope of at most 12.92).
+
+    Parameters
+    ----------
+    linear : np.array
+        numpy or torch linear image, values are clipped to range 0 - 1
+    gamma : float
+        gamma to use for encoding
+    lut_size : int
+        number of entries of the lookup table, see linear_to_srgb8_lut
+    out : np.array, optional
+        preallocated numpy uint8 array of the same shape to write the codes to, default: None (allocate)
+
+    Returns
+    -------
+    srgb8 : np.array
+        numpy or torch uint8 sRGB image
+    """
+
+    lut = linear_to_srgb8_lut(lut_size, gamma)
+
+    if isinstance(linear, np.ndarray):
+        index = np.clip(linear, 0, 1).astype(np.float32, copy=False)
+        index *= np.float32(lut_size - 1)
+        index += np.float32(0.5)
+        return np.take(lut, index.astype(np.intp), out=out)
+
+    if torch.is_tensor(linear):
+        index = (torch.clamp(linear, 0, 1) * (lut_size - 1) + 0.5).long()
+        return torch.from_numpy(lut.copy()).to(linear.device)[index]
+
+    raise Exception(f"Expected numpy or torch array, but got {type(linear)}.")
+
+
 # IMAGE LOADING + PROCESSING
 
-def load_image_np(image_path, return_linear=False):
+def _open_avif(image_path):
+    """ Opens an .avif image from a path or a PackedFrame of a packed dataset as RGB PIL image """
+
+    image = Image.open(image_path.open() if isinstance(image_path, PackedFrame) else str(image_path))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    return image
+
+
+def get_resized_size(height, width, downscale=None, target_size=None):
+    """ Computes the size of a reduced-resolution image, see load_image_np
+
+    Parameters
+    ----------
+    height, width : int
+        size of the full resolution image
+    downscale : int, optional
+        integer downscaling factor, default: None
+    target_size : int, tuple, optional
+        size of the longer image side or (W, H), default: None
+
+    Returns
+    -------
+    size : tuple or None
+        (W, H) of the reduced image, None if the image keeps its full resolution
+    """
+
+    assert downscale is None or target_size is None, "Either downscale or target_size can be given"
+
+    if downscale is not None and downscale > 1:
+        return (width // downscale, height // downscale)
+
+    if target_size is not None:
+        if np.isscalar(target_size):
+            scale = target_size / max(height, width)
+            return (max(1, round(width * scale)), max(1, round(height * scale)))
+        return tuple(int(x) for x in target_size)
+
+    return None
+
+
+def load_image_np(image_path, return_linear=False, downscale=None, target_size=None):
     """ Loads a .exr or .avif image into a numpy arrar
     Note: as of now (July 2025) pillow does not support loading >8-bit AVIF images
 
     Parameters
     ----------
-    image_path : Path, str
-        path to the image
+    image_path : Path, str, PackedFrame
+        path to the image or .avif frame of a packed dataset (see utils.packed_dataset)
     return_linear : bool
         return linear instead of sRGB encoded values
+    downscale : int, optional
+        load the image at 1 / downscale of its resolution, default: None (full resolution)
+    target_size : int, tuple, optional
+        load the image with this size of the longer side or as (W, H), default: None (full resolution).
+        Reduced images are area-averaged in linear space. Use their width as IMAGE_W of read_calib to get matching intrinsics.
 
     Returns
     -------
@@ -103,31 +274,174 @@ def load_image_np(image_path, return_linear=False):
         loaded numpy image (H, W, C) with values in range 0 - 1. Channels are in BGR order.
     """
 
-    image_path = str(image_path)
+    image_name = str(image_path)
 
-    if image_path.endswith('.exr'):
-        exr_image = cv2.imread(image_path, -1)
+    if image_name.endswith('.exr'):
+        exr_image = cv2.imread(image_name, -1)
         image_np = np.array(exr_image)
-        if return_linear:
-            return image_np
-        else:
-            return linear_to_srgb(image_np)
 
-    elif image_path.endswith('.avif'):
-        image = Image.open(image_path)
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+    elif image_name.endswith('.avif'):
+        image_u8 = np.asarray(_open_avif(image_path))[:, :, ::-1]
+        size = get_resized_size(image_u8.shape[0], image_u8.shape[1], downscale, target_size)
 
-        image_np = np.asarray(image).astype(np.float32)[:, :, ::-1] / 255.0        
-        
-        if return_linear:
-            return sRGB_to_linear(image_np)
+        if return_linear or size is not None:
+            # Only 256 possible values per channel, decode through a lookup table
+            image_np = srgb8_to_linear(image_u8)
         else:
-            return image_np
+            return image_u8.astype(np.float32) / 255.0
 
     else:
         raise ValueError("Unsupported file format.")
 
+    size = get_resized_size(image_np.shape[0], image_np.shape[1], downscale, target_size)
+    if size is not None:
+        image_np = cv2.resize(image_np, size, interpolation=cv2.INTER_AREA).reshape(size[1], size[0], -1)
+
+    if return_linear:
+        return image_np
+    else:
+        return linear_to_srgb(image_np)
+
+
+def write_image_into(out, image_np):
+    """ Writes an image with values in range 0 - 1 into a preallocated float or uint8 array.
+    uint8 arrays receive the rounded 8-bit codes (value * 255) instead of the values.
+
+    Parameters
+    ----------
+    out : np.array
+        preallocated float or uint8 array
+    image_np : np.array
+        image with values in range 0 - 1, same shape as out
+
+    Returns
+    -------
+    out : np.array
+        the filled out array
+    """
+
+    if out.dtype == np.uint8:
+        out[...] = np.rint(np.clip(image_np, 0, 1) * 255)
+    else:
+        out[...] = image_np
+
+    return out
+
+
+def load_image_into(image_path, out, return_linear=False, downscale=None, target_size=None):
+    """ Loads a .exr or .avif image into a preallocated array, see load_image_np
+
+    Parameters
+    ----------
+    image_path : Path, str, PackedFrame
+        path to the image or .avif frame of a packed dataset
+    out : np.array
+        preallocated (H, W, C) float array to decode the image into, or uint8 array to store 8-bit codes in (see write_image_into)
+    return_linear : bool
+        return linear instead of sRGB encoded values
+    downscale : int, optional
+        load the image at 1 / downscale of its resolution, default: None (full resolution)
+    target_size : int, tuple, optional
+        load the image with this size of the longer side or as (W, H), default: None (full resolution)
+
+    Returns
+    -------
+    out : np.array
+        the filled out array
+    """
+
+    if str(image_path).endswith('.avif') and downscale is None and target_size is None:
+        image_u8 = np.asarray(_open_avif(image_path))[:, :, ::-1]
+
+        if out.dtype == np.float32:
+            if return_linear:
+                np.take(srgb8_to_linear_lut(), image_u8, out=out)
+            else:
+                np.divide(image_u8, np.float32(255.0), out=out, casting='unsafe')
+            return out
+
+        if out.dtype == np.uint8 and not return_linear:
+            np.copyto(out, image_u8)
+            return out
+
+    return write_image_into(out, load_image_np(image_path, return_linear=return_linear, downscale=downscale, target_size=target_size))
+
+
+def load_images_np(image_paths, out=None, workers=None, return_linear=False, pixel_index=None, progress=True, downscale=None, target_size=None):
+    """ Loads a batch of .exr or .avif images of equal shape into one (N, H, W, C) array.
+    Images are decoded in a thread pool directly into the (preallocated) output.
+
+    Parameters
+    ----------
+    image_paths : list of Path, str, PackedFrame
+        paths to the images or frames of a packed dataset
+    out : np.array, optional
+        preallocated (N, H, W, C) float or uint8 array (e.g. a np.memmap) to decode the images into, default: None (allocate float32)
+    workers : int, optional
+        number of decoding threads, default: None (number of CPUs)
+    return_linear : bool
+        return linear instead of sRGB encoded values
+    pixel_index : np.array, optional
+        flat (row-major) indices of the pixels to keep, images are then returned packed as (N, P, C), default: None
+    progress : bool
+        show a progress bar, default: True
+    downscale : int, optional
+        load the images at 1 / downscale of their resolution, default: None (full resolution)
+    target_size : int, tuple, optional
+        load the images with this size of the longer side or as (W, H), default: None (full resolution)
+
+    Returns
+    -------
+    images_np : np.array
+        (N, H, W, C) or packed (N, P, C) images with values in range 0 - 1. Channels are in BGR order.
+    """
+
+    image_paths = list(image_paths)
+    start = 0
+
+    if out is None:
+        first_image = load_image_np(image_paths[0], return_linear=return_linear, downscale=downscale, target_size=target_size)
+        if pixel_index is not None:
+            first_image = first_image.reshape(-1, first_image.shape[-1])[pixel_index]
+        out = np.empty((len(image_paths),) + first_image.shape, dtype=np.float32)
+        out[0] = first_image
+        start = 1
+
+    assert len(out) == len(image_paths), f"Output has space for {len(out)} images, got {len(image_paths)} paths"
+
+    def load(idx):
+        if pixel_index is None:
+            load_image_into(image_paths[idx], out[idx], return_linear=return_linear, downscale=downscale, target_size=target_size)
+        else:
+            image_np = load_image_np(image_paths[idx], return_linear=return_linear, downscale=downscale, target_size=target_size)
+            write_image_into(out[idx], image_np.reshape(-1, image_np.shape[-1])[pixel_index])
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for _ in tqdm(pool.map(load, range(start, len(image_paths))), total=len(image_paths) - start, disable=not progress):
+            pass
+
+    return out
+
+
+def load_mask_np(mask_path):
+    """ Loads a segmentation mask (e.g. segmentations/masks/000/CamXX.png)
+
+    Parameters
+    ----------
+    mask_path : Path, str
+        path to the mask image
+
+    Returns
+    -------
+    mask_np : np.array
+        (H, W) boolean foreground mask
+    """
+
+    mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+    assert mask is not None, f"Unable to read mask {mask_path}"
+
+    return mask > 127
+
 
 def undistort_image_cv(img, intrinsic, distortion):
     """ Undistorts a given image with opencv
@@ -147,4 +461,206 @@ def undistort_image_cv(img, intrinsic, distortion):
         undistorted image
     """
 
-    return cv2.undistort(img, intrinsic[:3, :3], distortion)
\ No newline at end of file
+    return cv2.undistort(img, intrinsic[:3, :3], distortion)
+
+
+class Undistorter:
+    """Undistorts images of one camera like undistort_image_cv, but computes the undistortion map only once
+    (optionally cached on disk) and applies it with cv2.remap, for single images or batches in a thread pool"""
+
+    def __init__(self, intrinsic, distortion, image_size, cache_dir=None):
+        """
+        Parameters
+        ----------
+        intrinsic : np.array
+            intrinsic matrix of the camera (3x3 or 4x4, as read by read_calib for the image width)
+        distortion : np.array
+            opencv distortion coefficients
+        image_size : tuple
+            (W, H) of the images to undistort
+        cache_dir : Path, str, optional
+            directory to store the undistortion map in and load it from on later runs, e.g. per subject, default: None
+        """
+
+        self.intrinsic = np.asarray(intrinsic, dtype=np.float64)[:3, :3]
+        self.distortion = np.asarray(distortion, dtype=np.float64)
+        self.image_size = tuple(int(x) for x in image_size)
+
+        cache_path = None
+        if cache_dir is not None:
+            key = hashlib.sha256(self.intrinsic.tobytes() + self.distortion.tobytes() + repr(self.image_size).encode()).hexdigest()[:24]
+            cache_path = os.path.join(str(cache_dir), f"undistort_{key}.npz")
+
+            if os.path.isfile(cache_path):
+                with np.load(cache_path) as maps:
+                    self.map1, self.map2 = maps["map1"], maps["map2"]
+                return
+
+        # Same maps as used internally by cv2.undistort
+        self.map1, self.map2 = cv2.initUndistortRectifyMap(self.intrinsic, self.distortion, None, self.intrinsic, self.image_size, cv2.CV_16SC2)
+
+        if cache_path is not None:
+            os.makedirs(str(cache_dir), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=str(cache_dir), suffix=".tmp")
+            with os.fdopen(fd, "wb") as file:
+                np.savez(file, map1=self.map1, map2=self.map2)
+            os.replace(tmp_path, cache_path)
+
+    def undistort(self, img, out=None):
+        """ Undistorts a single image
+
+        Parameters
+        ----------
+        img : np.array
+            (H, W, C) numpy image to undistort
+        out : np.array, optional
+            preallocated array of the same shape and dtype to write the undistorted image to, default: None
+
+        Returns
+        -------
+        image : np.array
+            undistorted image
+        """
+
+        assert img.shape[1::-1] == self.image_size, f"Image shape {img.shape} does not match the undistortion map {self.image_size}"
+
+        undistorted = cv2.remap(np.ascontiguousarray(img), self.map1, self.map2, cv2.INTER_LINEAR)
+        if out is None:
+            return undistorted
+
+        out[...] = undistorted.reshape(out.shape)
+        return out
+
+    def undistort_batch(self, images, out=None, workers=None):
+        """ Undistorts a batch of images in a thread pool
+
+        Parameters
+        ----------
+        images : np.array
+            (N, H, W, C) numpy images to undistort
+        out : np.array, optional
+            preallocated (N, H, W, C) array to write the undistorted images to (may be images), default: None
+        workers : int, optional
+            number of threads, default: None (number of CPUs)
+
+        Returns
+        -------
+        images : np.array
+            (N, H, W, C) undistorted images
+        """
+
+        if out is None:
+            out = np.empty_like(images)
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            list(pool.map(lambda idx: self.undistort(images[idx], out=out[idx]), range(len(images))))
+
+        return out
+
+    def load_undistorted(self, image_path, out=None, return_linear=False):
+        """ Loads an image like load_image_np and undistorts it in one step. For .avif images the 8-bit codes are
+        decoded through a lookup table. Linear images are undistorted after decoding, so they match undistorting
+        load_image_np(..., return_linear=True). sRGB images are undistorted as 8-bit codes.
+
+        Parameters
+        ----------
+        image_path : Path, str
+            path to the image
+        out : np.array, optional
+            preallocated (H, W, C) float array to write the image to, or uint8 array to store 8-bit codes in, default: None
+        return_linear : bool
+            return linear instead of sRGB encoded values
+
+        Returns
+        -------
+        image_np : np.array
+            undistorted (H, W, C) image with values in range 0 - 1. Channels are in BGR order.
+        """
+
+        if not str(image_path).endswith('.avif'):
+            image_np = self.undistort(load_image_np(image_path, return_linear=return_linear))
+            return image_np if out is None else write_image_into(out, image_np)
+
+        image_u8 = np.asarray(_open_avif(image_path))[:, :, ::-1]
+
+        if return_linear:
+            # Interpolating sRGB codes would not match interpolating linear values
+            if out is not None and out.dtype == np.float32:
+                return self.undistort(srgb8_to_linear(image_u8), out=out)
+            image_np = self.undistort(srgb8_to_linear(image_u8))
+            return image_np if out is None else write_image_into(out, image_np)
+
+        image_u8 = self.undistort(image_u8)
+
+        if out is None:
+            return image_u8.astype(np.float32) / 255.0
+
+        if out.dtype == np.uint8:
+            np.copyto(out, image_u8)
+        else:
+            write_image_into(out, image_u8.astype(np.float32) / 255.0)
+
+        return out
+
+    def load_undistorted_batch(self, image_paths, out=None, workers=None, return_linear=False, progress=True):
+        """ Loads and undistorts a batch of images of this camera in a thread pool, see load_images_np
+
+        Parameters
+        ----------
+        image_paths : list of Path, str
+            paths to the images
+        out : np.array, optional
+            preallocated (N, H, W, C) float or uint8 array to write the images to, default: None (allocate float32)
+        workers : int, optional
+            number of threads, default: None (number of CPUs)
+        return_linear : bool
+            return linear instead of sRGB encoded values
+        progress : bool
+            show a progress bar, default: True
+
+        Returns
+        -------
+        images_np : np.array
+            (N, H, W, C) undistorted images with values in range 0 - 1. Channels are in BGR order.
+        """
+
+        image_paths = list(image_paths)
+        start = 0
+
+        if out is None:
+            first_image = self.load_undistorted(image_paths[0], return_linear=return_linear)
+            out = np.empty((len(image_paths),) + first_image.shape, dtype=np.float32)
+            out[0] = first_image
+            start = 1
+
+        assert len(out) == len(image_paths), f"Output has space for {len(out)} images, got {len(image_paths)} paths"
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            loads = pool.map(lambda idx: self.load_undistorted(image_paths[idx], out=out[idx], return_linear=return_linear), range(start, len(image_paths)))
+            for _ in tqdm(loads, total=len(image_paths) - start, disable=not progress):
+                pass
+
+        return out
+
+
+def load_undistorters(calib_dir, image_size, cache_dir=None):
+    """ Creates an Undistorter for every camera of a cameras.calib
+
+    Parameters
+    ----------
+    calib_dir : Path, str
+        path to directory containing the cameras.calib (e.g. SUBJECT/shared)
+    image_size : tuple
+        (W, H) of the images to undistort, e.g. of images_raw
+    cache_dir : Path, str, optional
+        directory to cache the undistortion maps in, see Undistorter, default: None
+
+    Returns
+    -------
+    undistorters : list of Undistorter
+        undistorter of each camera, undistorters[i] belongs to Cam{i+1:02}
+    """
+
+    rig = load_camera_rig(calib_dir, image_size[0])
+
+    return [Undistorter(intrinsic, distortion, image_size, cache_dir=cache_dir) for intrinsic, distortion in zip(rig.intrinsics, rig.distortion)]
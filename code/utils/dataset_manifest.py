@@ -0,0 +1,253 @@
+from PIL import Image
+import pillow_avif # Depending on your python version, this may already be included in PIL
+import gzip, json, os, struct, tempfile
+from utils.packed_dataset import PackedFrame
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+
+# DATASET MANIFEST
+# Index of the dataset tree (subjects, poses, cameras, sorted frame lists, image sizes and shared calibration/light
+# files), built by a single parallel scan and stored in one gzipped .json. Refreshing rescans only the camera
+# directories whose modification time changed.
+
+MANIFEST_VERSION = 1
+
+
+def read_image_size(image_path):
+    """ Reads the size of an .avif or .exr image from its header, without decoding the image
+
+    Parameters
+    ----------
+    image_path : Path, str, PackedFrame
+        path to the image or .avif frame of a packed dataset
+
+    Returns
+    -------
+    size : tuple
+        (W, H) of the image
+    """
+
+    if isinstance(image_path, PackedFrame):
+        with Image.open(image_path.open()) as image:
+            return image.size
+
+    image_path = str(image_path)
+
+    if image_path.endswith('.exr'):
+        with open(image_path, "rb") as file:
+            magic, _ = struct.unpack("<ii", file.read(8))
+            assert magic == 20000630, f"{image_path} is not an OpenEXR file"
+
+            # Header attributes: name\0 type\0 size value, terminated by an empty name
+            while True:
+                name = b"".join(iter(lambda: file.read(1), b"\0"))
+                if len(name) == 0:
+                    break
+                b"".join(iter(lambda: file.read(1), b"\0")) # Attribute type
+                size, = struct.unpack("<i", file.read(4))
+                value = file.read(size)
+                if name == b"dataWindow":
+                    xmin, ymin, xmax, ymax = struct.unpack("<iiii", value)
+                    return (xmax - xmin + 1, ymax - ymin + 1)
+
+        raise ValueError(f"No dataWindow in the header of {image_path}")
+
+    # PIL only parses the header until the pixels are accessed
+    with Image.open(image_path) as image:
+        return image.size
+
+
+def _scan_camera(cam_dir, image_end):
+    # The mtime is read before listing, so files added during the listing change it and are found by the next refresh
+    mtime = os.stat(str(cam_dir)).st_mtime
+    frames = sorted(entry.name for entry in os.scandir(str(cam_dir)) if entry.name.endswith(image_end))
+    size = list(read_image_size(Path(cam_dir) / frames[0])) if len(frames) > 0 else None
+
+    return dict(mtime=mtime, frames=frames, size=size)
+
+
+class DatasetManifest:
+    """Index of a dataset tree, see build_manifest"""
+
+    def __init__(self, dataset_dir, entries=None):
+        """
+        Parameters
+        ----------
+        dataset_dir : Path, str
+            path to the dataset root
+        entries : dict, optional
+            manifest contents as written by save, default: None (empty)
+        """
+
+        self.dataset_dir = Path(dataset_dir)
+        self.entries = entries if entries is not None else dict(version=MANIFEST_VERSION, subjects=dict())
+
+    def refresh(self, image_dirs=("images_processed",), image_end=".avif", workers=16, subjects=None):
+        """ Scans the dataset tree and updates the manifest. Camera directories whose modification time did not
+        change since the last scan are not listed again.
+
+        Parameters
+        ----------
+        image_dirs : list of str, optional
+            names of the image directories to index, the entries of all other image directories are kept, default: ("images_processed",)
+        image_end : str, optional
+            type of images to index, default: ".avif"
+        workers : int, optional
+            number of camera directories scanned in parallel, default: 16
+        subjects : list of str, optional
+            subjects to scan, the entries of all other subjects are kept as they are, default: None (all)
+
+        Returns
+        -------
+        n_scanned : int
+            number of camera directories which were (re)scanned
+        """
+
+        old_subjects = self.entries["subjects"]
+        if subjects is None:
+            subject_dirs = sorted(self.dataset_dir.glob("SUBJECT_*"))
+            new_subjects = dict()
+        else:
+            subject_dirs = [self.dataset_dir / subject for subject in subjects if (self.dataset_dir / subject).is_dir()]
+            new_subjects = {subject: entry for subject, entry in old_subjects.items() if subject not in subjects}
+        to_scan = [] # (cam entry dict, key, cam dir)
+
+        for subject_dir in subject_dirs:
+            old_subject = old_subjects.get(subject_dir.name, dict(poses=dict()))
+            shared = subject_dir / "shared"
+
+            subject = dict(shared=dict(
+                calib_dir="shared" if (shared / "cameras.calib").is_file() or (shared / "camera.calib").is_file() else None,
+                light_positions="shared/LSX_light_positions_aligned.pc" if (shared / "LSX_light_positions_aligned.pc").is_file() else None,
+                light_order="shared/LSX3_light_z_spiral.txt" if (shared / "LSX3_light_z_spiral.txt").is_file() else None,
+            ), poses=dict())
+
+            for pose_dir in sorted(subject_dir.glob("POSE_*")):
+                old_pose = old_subject["poses"].get(pose_dir.name, dict())
+                # Image directories which are not scanned keep their entries
+                pose = subject["poses"][pose_dir.name] = {image_dir: cams for image_dir, cams in old_pose.items() if image_dir not in image_dirs}
+
+                for image_dir in image_dirs:
+                    old_cams = old_pose.get(image_dir, dict())
+                    cams = pose[image_dir] = dict()
+
+                    for cam_dir in sorted((pose_dir / image_dir).glob("Cam*")):
+                        old_cam = old_cams.get(cam_dir.name)
+                        if old_cam is not None and old_cam["mtime"] == os.stat(str(cam_dir)).st_mtime:
+                            cams[cam_dir.name] = old_cam
+                        else:
+                            to_scan.append((cams, cam_dir.name, cam_dir))
+
+            new_subjects[subject_dir.name] = subject
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            scanned = pool.map(lambda item: _scan_camera(item[2], image_end), to_scan)
+            for (cams, cam, _), cam_entry in zip(to_scan, scanned):
+                cams[cam] = cam_entry
+
+        self.entries["subjects"] = dict(sorted(new_subjects.items()))
+        return len(to_scan)
+
+    def save(self, manifest_path):
+        """Writes the manifest to a gzipped .json (via a temporary file, so readers never see partial manifests)"""
+
+        manifest_path = Path(manifest_path)
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=str(manifest_path.parent), suffix=".tmp")
+        with gzip.open(os.fdopen(fd, "wb"), "wt") as file:
+            json.dump(self.entries, file, separators=(",", ":"))
+        os.replace(tmp_path, str(manifest_path))
+
+    @classmethod
+    def load(cls, dataset_dir, manifest_path):
+        """Reads a manifest written by save, returns None if it does not exist or is outdated"""
+
+        try:
+            with gzip.open(str(manifest_path), "rt") as file:
+                entries = json.load(file)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+
+        if entries.get("version") != MANIFEST_VERSION:
+            return None
+
+        return cls(dataset_dir, entries)
+
+    def subjects(self):
+        return sorted(self.entries["subjects"].keys())
+
+    def poses(self, subject):
+        return sorted(self.entries["subjects"][subject]["poses"].keys())
+
+    def cams(self, subject, pose, image_dir="images_processed"):
+        return sorted(self.entries["subjects"][subject]["poses"][pose].get(image_dir, dict()).keys())
+
+    def frames(self, subject, pose, cam, image_dir="images_processed"):
+        """Returns the sorted image paths of a camera directory, e.g. frames("SUBJECT_C058", "POSE_00", "Cam01")"""
+
+        cam_dir = self.dataset_dir / subject / pose / image_dir / cam
+        return [cam_dir / name for name in self.entries["subjects"][subject]["poses"][pose][image_dir][cam]["frames"]]
+
+    def image_size(self, subject, pose, cam, image_dir="images_processed"):
+        """Returns the (W, H) of the images of a camera directory, None if it contains no images"""
+
+        size = self.entries["subjects"][subject]["poses"][pose][image_dir][cam]["size"]
+        return tuple(size) if size is not None else None
+
+    def shared_path(self, subject, name):
+        """ Returns the path of a shared file of subject
+
+        Parameters
+        ----------
+        subject : str
+            subject, e.g. "SUBJECT_C058"
+        name : str
+            "calib_dir" (directory containing the cameras.calib), "light_positions" or "light_order"
+
+        Returns
+        -------
+        path : Path or None
+            path of the file, None if the subject does not provide it
+        """
+
+        relative = self.entries["subjects"][subject]["shared"][name]
+        return self.dataset_dir / subject / relative if relative is not None else None
+
+
+def build_manifest(dataset_dir, manifest_path=None, image_dirs=("images_processed",), image_end=".avif", workers=16, subjects=None):
+    """ Loads the manifest of a dataset, refreshes it incrementally and stores it again
+
+    Parameters
+    ----------
+    dataset_dir : Path, str
+        path to the dataset root
+    manifest_path : Path, str, optional
+        gzipped .json to read the previous manifest from and write the refreshed one to, default: None (scan without storing)
+    image_dirs : list of str, optional
+        names of the image directories to index, default: ("images_processed",)
+    image_end : str, optional
+        type of images to index, default: ".avif"
+    workers : int, optional
+        number of camera directories scanned in parallel, default: 16
+    subjects : list of str, optional
+        subjects to scan, the stored entries of all other subjects are kept, default: None (all)
+
+    Returns
+    -------
+    manifest : DatasetManifest
+        up to date manifest of the dataset
+    """
+
+    manifest = DatasetManifest.load(dataset_dir, manifest_path) if manifest_path is not None else None
+    if manifest is None:
+        manifest = DatasetManifest(dataset_dir)
+
+    n_scanned = manifest.refresh(image_dirs=image_dirs, image_end=image_end, workers=workers, subjects=subjects)
+    print(f"Manifest of {dataset_dir}: scanned {n_scanned} camera directories")
+
+    if manifest_path is not None:
+        manifest.save(manifest_path)
+
+    return manifest
@@ -1,9 +1,127 @@
 import numpy as np
-import os
+import os, tempfile
 
 # Light reader
-def read_OLAT_info(lights_pos_file, lights_order_file, OLAT_START=14, OLAT_FB_MODULO=21, exclude_door_lights=True):
-    """ Reads a list of valid light positions and associated image indices 
+
+# Hard-coded door light indices (0-based indices into the light positions file)
+DOOR_LIGHTS = [178, 179, 208, 209, 210, 237, 238, 239, 240, 267, 268, 269, 270, 271, 295, 296, 297, 298, 319, 320, 321]
+
+_LIGHT_RIGS = dict() # (files, mtimes, OLAT_START, OLAT_FB_MODULO) -> LightRig
+
+
+class LightRig:
+    """Lights of a capture with dense lookup tables between lights and camera frames, see load_light_rig.
+    Lights are ordered as in the light order file (the order in which they are recorded), door lights included."""
+
+    def __init__(self, positions, light_index, light_frame, door):
+        """
+        Parameters
+        ----------
+        positions : np.array
+            (N_LIGHTS, 3) light positions in meters (m)
+        light_index : np.array
+            (N_LIGHTS,) index of each light in the light positions file
+        light_frame : np.array
+            (N_LIGHTS,) index of the camera frame where only the light is active
+        door : np.array
+            (N_LIGHTS,) True for lights on the hatch
+        """
+
+        self.positions = positions
+        self.light_index = light_index
+        self.light_frame = light_frame
+        self.door = door
+
+        # frame_to_light[frame] => light active in frame, -1 for fullbright frames
+        self.frame_to_light_table = np.full(light_frame.max() + 1 if len(light_frame) > 0 else 0, -1, dtype=np.int64)
+        self.frame_to_light_table[light_frame] = np.arange(len(light_frame))
+
+        for array in [self.positions, self.light_index, self.light_frame, self.door, self.frame_to_light_table]:
+            array.flags.writeable = False # Rigs are shared between callers
+
+    def __len__(self):
+        return len(self.light_frame)
+
+    def frame_to_light(self, n_frames):
+        """ Returns the light of each of the first n_frames camera frames
+
+        Parameters
+        ----------
+        n_frames : int
+            number of frames in the camera sequence
+
+        Returns
+        -------
+        frame_to_light : np.array
+            (n_frames,) index of the light active in each frame, -1 for fullbright frames
+        """
+
+        frame_to_light = np.full(n_frames, -1, dtype=np.int64)
+        n_known = min(n_frames, len(self.frame_to_light_table))
+        frame_to_light[:n_known] = self.frame_to_light_table[:n_known]
+
+        return frame_to_light
+
+    def olat_info(self, exclude_door_lights=True):
+        """ Returns light positions and image indices like read_OLAT_info
+
+        Parameters
+        ----------
+        exclude_door_lights : bool
+            do not include lights on the hatch
+
+        Returns
+        -------
+        light_positions : np.array
+            (N_LIGHTS, 3) array containing light positions in meters (m)
+        light_img : np.array
+            (N_LIGHTS) array where light_img[i] => index of camera image where only light at light_positions[i] is active
+        """
+
+        if exclude_door_lights:
+            return self.positions[~self.door], self.light_frame[~self.door]
+
+        return self.positions.copy(), self.light_frame.copy()
+
+
+def olat_frames(N_LIGHTS, OLAT_START=14, OLAT_FB_MODULO=21):
+    """ Computes the camera frame of each light in recording order
+
+    Parameters
+    ----------
+    N_LIGHTS : int
+        number of lights
+    OLAT_START : int
+        index of frame in camera sequence where OLAT starts (fullbright (FB) frame before only one light is active)
+    OLAT_FB_MODULO : int
+        frequency of multiplexed FB images/number of images in one multiplex cycle (<= 0 if no multiplexing)
+
+    Returns
+    -------
+    light_frame : np.array
+        (N_LIGHTS,) index of the camera frame of the i-th recorded light
+    """
+
+    assert OLAT_FB_MODULO != 1
+
+    N_IMGS = N_LIGHTS+1 # (+1 for first fullbright, does NOT account for FB reconstruction frames)
+
+    # Account for FB reconstruction frames
+    if OLAT_FB_MODULO > 0:
+        N_IMGS += N_LIGHTS//(OLAT_FB_MODULO-1) # After this, N_IMGS should be the length of the olat recording (including FB reconstruction frames)
+
+    # Relevant slice of frames, without the multiplexed FB frames
+    light_frame = np.arange(OLAT_START, OLAT_START+N_IMGS)
+    if OLAT_FB_MODULO > 0:
+        light_frame = light_frame[np.arange(N_IMGS) % OLAT_FB_MODULO != OLAT_FB_MODULO-1]
+
+    # Get rid of beginning and end FB frames
+    return light_frame[1:N_LIGHTS+1]
+
+
+def load_light_rig(lights_pos_file, lights_order_file, OLAT_START=14, OLAT_FB_MODULO=21):
+    """ Reads the lights of a capture as a LightRig. Rigs are memoized per files and OLAT parameters,
+    repeated calls return the same (read-only) rig.
 
     Parameters
     ----------
@@ -15,88 +133,70 @@ def read_OLAT_info(lights_pos_file, lights_order_file, OLAT_START=14, OLAT_FB_MO
         index of frame in camera sequence where OLAT starts (fullbright (FB) frame before only one light is active)
     OLAT_FB_MODULO : int
         frequency of multiplexed FB images/number of images in one multiplex cycle (<= 0 if no multiplexing)
-    exclude_door_lights : bool
-        do not include lights on the hatch in the final list of valid light positions (recommended when light position is required for compute)
 
     Returns
     -------
-    light_positions : np.array
-        (N_LIGHTS, 3) array containing light positions in meters (m)
-    light_img : np.array
-        (N_LIGHTS) array where light_img[i] => index of camera image where only light at light_positions[i] is active
-        index of camera image is the same as the six digit id in the image name
+    rig : LightRig
+        lights in recording order
     """
-   
+
     assert OLAT_FB_MODULO != 1
 
-    # Hard-coded door light indices
-    door_lights = [178, 179, 208, 209, 210, 237, 238, 239, 240, 267, 268, 269, 270, 271, 295, 296, 297, 298, 319, 320, 321]
+    lights_pos_file, lights_order_file = os.path.abspath(str(lights_pos_file)), os.path.abspath(str(lights_order_file))
+    key = (lights_pos_file, os.stat(lights_pos_file).st_mtime, lights_order_file, os.stat(lights_order_file).st_mtime, OLAT_START, OLAT_FB_MODULO)
 
-    light_positions = []
-    light_sequence = []
-    light_img = []
+    if key in _LIGHT_RIGS.keys():
+        return _LIGHT_RIGS[key]
 
     # Read .pc containing light positions
-    with open(str(lights_pos_file), "r") as file:
-        for line in file:
-            line = line.rstrip().split()
-            if line[0] != 'v':
-                continue
-
-            light_positions.append([float(line[1]), float(line[2]), float(line[3])])
+    with open(lights_pos_file, "r") as file:
+        rows = [line.split()[1:4] for line in file if line.split()[:1] == ['v']]
+    light_positions = np.array(rows, dtype=float).reshape(-1, 3)
 
     # Read .txt containing light pattern (first light indexed as 1)
-    with open(str(lights_order_file), "r") as file:
-        for line in file:
-            light_sequence.append(int(line.rstrip()) - 1)
+    with open(lights_order_file, "r") as file:
+        light_sequence = np.array(file.read().split(), dtype=np.int64) - 1
 
     # Generate associations to image files
     N_LIGHTS = len(light_positions)
-    N_IMGS = N_LIGHTS+1 # (+1 for first fullbright, does NOT account for FB reconstruction frames)
+    light_frame = olat_frames(N_LIGHTS, OLAT_START, OLAT_FB_MODULO)
 
-    # Account for FB reconstruction frames
-    if OLAT_FB_MODULO > 0:
-        N_IMGS += N_LIGHTS//(OLAT_FB_MODULO-1) # After this, N_IMGS should be the length of the olat recording (including FB reconstruction frames)
+    # Sanity check
+    assert N_LIGHTS == len(light_frame) and N_LIGHTS == len(light_sequence)
 
-    # Relevant slice of frames
-    light_img = list(range(OLAT_START, OLAT_START+N_IMGS))
+    rig = LightRig(light_positions[light_sequence], light_sequence, light_frame, np.isin(light_sequence, DOOR_LIGHTS))
+    _LIGHT_RIGS[key] = rig
 
-    # Get rid of multiplexed FB frames
-    if OLAT_FB_MODULO > 0:
-        del light_img[OLAT_FB_MODULO-1::OLAT_FB_MODULO]
+    return rig
 
-    # Get rid of beginning and end FB frames
-    light_img = light_img[1:len(light_positions)+1]
 
-    # Sanity check
-    assert len(light_positions) == len(light_img) and len(light_positions) == len(light_sequence)
-
-    # If requested, remove lights in door_lights
-    if exclude_door_lights:
-        new_light_sequence = []
-        to_remove = []
-        for i in range(len(light_sequence)):
-            if light_sequence[i] in door_lights:
-                to_remove.append(i)
-                continue
-
-            new_light_sequence.append(light_sequence[i])
-            
-        for index in sorted(to_remove, reverse=True):
-            del light_img[index]
-
-        light_sequence = new_light_sequence
-    
-    # Finalize lists to return
-    light_sequence = np.array(light_sequence)
-    light_positions = np.array(light_positions)[light_sequence]
-    light_img = np.array(light_img)
+def read_OLAT_info(lights_pos_file, lights_order_file, OLAT_START=14, OLAT_FB_MODULO=21, exclude_door_lights=True):
+    """ Reads a list of valid light positions and associated image indices 
+    The lights are read once into a shared LightRig, see load_light_rig.
 
-    # Final sanity check and return
-    assert len(light_img) == len(light_sequence) and len(light_positions) == len(light_img)
+    Parameters
+    ----------
+    lights_pos_file : Path, str
+        path to .pc containing light positions (LSX_light_positions_aligned.pc)
+    lights_order_file : Path, str 
+        path to .txt containing light order (LSX3_light_z_spiral.txt)
+    OLAT_START : int
+        index of frame in camera sequence where OLAT starts (fullbright (FB) frame before only one light is active)
+    OLAT_FB_MODULO : int
+        frequency of multiplexed FB images/number of images in one multiplex cycle (<= 0 if no multiplexing)
+    exclude_door_lights : bool
+        do not include lights on the hatch in the final list of valid light positions (recommended when light position is required for compute)
 
+    Returns
+    -------
+    light_positions : np.array
+        (N_LIGHTS, 3) array containing light positions in meters (m)
+    light_img : np.array
+        (N_LIGHTS) array where light_img[i] => index of camera image where only light at light_positions[i] is active
+        index of camera image is the same as the six digit id in the image name
+    """
 
-    return light_positions, light_img
+    return load_light_rig(lights_pos_file, lights_order_file, OLAT_START, OLAT_FB_MODULO).olat_info(exclude_door_lights)
 
 # Camera reader
 def read_calib(calib_dir, IMAGE_W, INTR, EXTR, scale_to_meters=False, DISTOR=None, invert_extr=True, focal_length=None):
@@ -107,7 +207,8 @@ def read_calib(calib_dir, IMAGE_W, INTR, EXTR, scale_to_meters=False, DISTOR=Non
     calib_dir : Path, str
         path to directory containing the cameras.calib
     IMAGE_W : int
-        width of the image for which to read intrinsics (read and get the shape of the first image for correct value)
+        width of the image for which to read intrinsics (read and get the shape of the first image for correct value),
+        for images loaded at reduced resolution (downscale/target_size) this is the reduced width
     INTR : list
         an empty! list for storing read intrinsics
     EXTR : list
@@ -192,11 +293,167 @@ def read_calib(calib_dir, IMAGE_W, INTR, EXTR, scale_to_meters=False, DISTOR=Non
                 intrinsic[1,1] *= IMAGE_W
 			   
                                     		  			  
-                INTR.append(intrinsic) 
-			   
-		  
+                INTR.append(intrinsic)
+
+
+# Camera rig: all cameras of a cameras.calib as batched arrays, parsed once per file
+
+_CALIB_CACHE = dict() # (calib file, mtime) -> parsed calibration
+_CAMERA_RIGS = dict() # (calib file, mtime, IMAGE_W, scale_to_meters) -> CameraRig
+
+
+class CameraRig:
+    """Cameras of a cameras.calib as batched arrays, see load_camera_rig"""
+
+    def __init__(self, c2w, w2c, intrinsics, distortion, focal_length, image_width):
+        """
+        Parameters
+        ----------
+        c2w : np.array
+            (N, 4, 4) camera-to-world extrinsics (as read_calib with invert_extr=False)
+        w2c : np.array
+            (N, 4, 4) world-to-camera extrinsics (as read_calib with invert_extr=True)
+        intrinsics : np.array
+            (N, 4, 4) intrinsics for images of width image_width
+        distortion : np.array
+            (N, D) opencv distortion coefficients
+        focal_length : np.array
+            (N,) focal lengths
+        image_width : int
+            width of the images the intrinsics belong to
+        """
+
+        self.c2w = c2w
+        self.w2c = w2c
+        self.intrinsics = intrinsics
+        self.distortion = distortion
+        self.focal_length = focal_length
+        self.image_width = image_width
+
+        for array in [self.c2w, self.w2c, self.intrinsics, self.distortion, self.focal_length]:
+            array.flags.writeable = False # Rigs are shared between callers
+
+    def __len__(self):
+        return len(self.c2w)
+
+
+def _find_calib_file(calib_dir):
+    calib_file = os.path.join(str(calib_dir), 'cameras.calib')
+    if not os.path.isfile(calib_file):
+        calib_file = calib_file.replace('cameras.calib', 'camera.calib')
+
+    return os.path.abspath(calib_file)
+
+
+def _parse_calib(calib_file):
+    """ Parses a cameras.calib like read_calib, but converts all cameras at once
+
+    Returns
+    -------
+    calib : dict
+        (N, 3, 4) float32 "extrinsics" in mm as stored, (N, 3, 3) float32 "intrinsics" normalized by the image width,
+        (N, D) "distortion" and (N,) "focal_length"
+    """
+
+    with open(calib_file, 'r') as fp:
+        lines = fp.read().splitlines()
+
+    extrinsic_rows, intrinsic_rows, distortions, focal_lengths = [], [], [], []
+
+    i = 0
+    while i < len(lines):
+        text = lines[i]
+        i += 1
+
+        if 'distortionModel' in text:
+            continue
+        if 'distortion' in text:
+            distortions.append(np.fromstring(text.replace('distortion', ''), dtype=float, sep=' '))
+        if 'focalLength' in text:
+            focal_lengths.append(float(text.replace('focalLength', '').split()[0]))
+
+        if "pixelAspect" in text:
+            pass
+        elif "extrinsic" in text:
+            extrinsic_rows += [line.strip('#') for line in lines[i:i + 3]]
+            i += 3
+        elif "intrinsic" in text:
+            if i < len(lines) and "time" in lines[i]:
+                i += 1
+                continue
+            intrinsic_rows += [line.strip('#') for line in lines[i:i + 3]]
+            i += 4 # As in read_calib, the line following an intrinsic block is skipped
+
+    # Parse the numbers of all cameras in one go
+    return dict(
+        extrinsics=np.array(" ".join(extrinsic_rows).split(), dtype=float).astype(np.float32).reshape(-1, 3, 4),
+        intrinsics=np.array(" ".join(intrinsic_rows).split(), dtype=float).astype(np.float32).reshape(-1, 3, 3),
+        distortion=np.array(distortions, dtype=float).reshape(len(distortions), -1),
+        focal_length=np.array(focal_lengths, dtype=float),
+    )
+
+
+def load_camera_rig(calib_dir, IMAGE_W, scale_to_meters=False, persist=False):
+    """ Reads camera intrinsics, extrinsics and distortion of all cameras in the .calib file as a CameraRig.
+    Rigs are memoized per calib file and image width, repeated calls return the same (read-only) rig.
+
+    Parameters
+    ----------
+    calib_dir : Path, str
+        path to directory containing the cameras.calib
+    IMAGE_W : int
+        width of the images for which to compute intrinsics, see read_calib
+    scale_to_meters : bool, optional
+        scale the extrinsics to meters, default: False (mm)
+    persist : bool, optional
+        store the parsed calibration next to the calib file (cameras.calib.npz) and reuse it in later runs, default: False
+
+    Returns
+    -------
+    rig : CameraRig
+        cameras ordered as in the calib file, camera i belongs to Cam{i+1:02}
+    """
+
+    calib_file = _find_calib_file(calib_dir)
+    mtime = os.stat(calib_file).st_mtime
+    rig_key = (calib_file, mtime, IMAGE_W, scale_to_meters)
+
+    if rig_key in _CAMERA_RIGS.keys():
+        return _CAMERA_RIGS[rig_key]
+
+    if (calib_file, mtime) not in _CALIB_CACHE.keys():
+        calib = None
+        persist_file = calib_file + ".npz"
+
+        if persist and os.path.isfile(persist_file) and os.stat(persist_file).st_mtime >= mtime:
+            with np.load(persist_file) as npz:
+                calib = {name: npz[name] for name in npz.files}
+
+        if calib is None:
+            calib = _parse_calib(calib_file)
+            if persist:
+                # Write to a unique temporary file first, so concurrent processes never share or read partial files
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(persist_file) or ".", prefix=os.path.basename(persist_file) + ".", suffix=".tmp")
+                with os.fdopen(fd, "wb") as file:
+                    np.savez(file, **calib)
+                os.replace(tmp_path, persist_file)
+
+        _CALIB_CACHE[(calib_file, mtime)] = calib
 
+    calib = _CALIB_CACHE[(calib_file, mtime)]
 
+    c2w = np.zeros((len(calib["extrinsics"]), 4, 4), dtype=np.float32)
+    c2w[:, :3] = calib["extrinsics"]
+    c2w[:, 3, 3] = 1
+    if scale_to_meters:
+        c2w[:, :3, 3] /= 1000.0
 
+    intrinsics = np.zeros((len(calib["intrinsics"]), 4, 4), dtype=np.float32)
+    intrinsics[:, :3, :3] = calib["intrinsics"]
+    intrinsics[:, 3, 3] = 1
+    intrinsics[:, [0, 1, 0, 1], [2, 2, 0, 1]] *= IMAGE_W # cx, cy, fx, fy
 
+    rig = CameraRig(c2w, np.linalg.inv(c2w), intrinsics, calib["distortion"].copy(), calib["focal_length"].copy(), IMAGE_W)
+    _CAMERA_RIGS[rig_key] = rig
 
+    return rig
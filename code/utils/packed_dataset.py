@@ -0,0 +1,350 @@
+import numpy as np
+import io, os, threading, zlib
+from collections import OrderedDict
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+
+# PACKED DATASET
+# Each camera directory of a pose (e.g. SUBJECT/POSE/images_processed/CamXX/*.avif) is packed into one shard
+# CamXX.pack holding the original AVIF files back to back, and an index CamXX.index.npz with the file names,
+# byte offsets and CRC32 checksums. Shards are read in chunks of consecutive frames, so sequential and range
+# access needs one read per chunk instead of one file open per frame.
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".index.npz"
+
+
+class PackedFrame:
+    """A single image inside a PackedShard, accepted in place of an image path by utils.load_image_np"""
+
+    def __init__(self, shard, index):
+        self.shard = shard
+        self.index = index
+
+    @property
+    def name(self):
+        return self.shard.names[self.index]
+
+    def open(self):
+        """Returns the file contents as a binary file object"""
+        return io.BytesIO(self.shard.read_bytes(self.index))
+
+    def __str__(self):
+        # Ends with the file name, so the image type can be told from the suffix like for paths
+        return f"{self.shard.pack_path}::{self.name}"
+
+    def __repr__(self):
+        return f"PackedFrame({self})"
+
+
+class PackedShard:
+    """Random and range access to the frames of one packed camera directory, with chunk caching and prefetching"""
+
+    def __init__(self, pack_path, cache_chunks=4, prefetch=True):
+        """
+        Parameters
+        ----------
+        pack_path : Path, str
+            path to the CamXX.pack shard, its index is expected next to it
+        cache_chunks : int, optional
+            number of chunks kept in memory, default: 4
+        prefetch : bool, optional
+            read the next chunk in the background when a chunk is accessed, default: True
+        """
+
+        self.pack_path = Path(pack_path)
+        self.cache_chunks = max(cache_chunks, 2)
+        self.prefetch = prefetch
+
+        with np.load(index_path(self.pack_path)) as index:
+            self.names = [str(name) for name in index["names"]]
+            self.offsets = index["offsets"]
+            self.crc32 = index["crc32"]
+            self.chunk_size = int(index["chunk_size"])
+
+        self.n_chunks = (len(self.names) + self.chunk_size - 1) // self.chunk_size
+
+        self.chunks = OrderedDict() # Chunk index -> future of the chunk bytes, in LRU order
+        self.lock = threading.Lock()
+        self.reader = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _read_chunk(self, chunk):
+        start, stop = self.offsets[chunk * self.chunk_size], self.offsets[min((chunk + 1) * self.chunk_size, len(self.names))]
+        with open(str(self.pack_path), "rb") as file:
+            file.seek(int(start))
+            return file.read(int(stop - start))
+
+    def _request_chunk(self, chunk):
+        # Must be called with the lock held
+        if chunk in self.chunks.keys():
+            self.chunks.move_to_end(chunk)
+        else:
+            self.chunks[chunk] = self.reader.submit(self._read_chunk, chunk)
+            while len(self.chunks) > self.cache_chunks:
+                self.chunks.popitem(last=False)
+
+        return self.chunks[chunk]
+
+    def read_chunk(self, chunk):
+        """Returns the bytes of chunk, read from the cache if possible"""
+
+        with self.lock:
+            future = self._request_chunk(chunk)
+            if self.prefetch and chunk + 1 < self.n_chunks:
+                self._request_chunk(chunk + 1)
+                self.chunks.move_to_end(chunk) # The requested chunk stays the most recently used
+
+        return future.result()
+
+    def read_bytes(self, idx):
+        """ Returns the file contents of frame idx
+
+        Parameters
+        ----------
+        idx : int
+            index of the frame in the (sorted) camera directory
+
+        Returns
+        -------
+        data : bytes
+            original file contents
+        """
+
+        if idx < 0 or idx >= len(self.names):
+            raise IndexError("Frame index out of range")
+
+        chunk = idx // self.chunk_size
+        base = self.offsets[chunk * self.chunk_size]
+        data = self.read_chunk(chunk)
+
+        return data[int(self.offsets[idx] - base):int(self.offsets[idx + 1] - base)]
+
+    def read_range(self, start, stop):
+        """Returns the file contents of frames start to stop (exclusive)"""
+        return [self.read_bytes(idx) for idx in range(start, min(stop, len(self.names)))]
+
+    def frames(self):
+        """Returns all frames as PackedFrames, ordered like the sorted camera directory"""
+        return [PackedFrame(self, idx) for idx in range(len(self.names))]
+
+    def verify(self, source_dir=None):
+        """ Checks the frames against their checksums and, if given, against the source files
+
+        Parameters
+        ----------
+        source_dir : Path, str, optional
+            camera directory the shard was packed from, default: None (checksums only)
+
+        Returns
+        -------
+        mismatches : list of str
+            names of the frames which do not match
+        """
+
+        mismatches = []
+        for idx, name in enumerate(self.names):
+            data = self.read_bytes(idx)
+            if zlib.crc32(data) != self.crc32[idx]:
+                mismatches.append(name)
+            elif source_dir is not None and (not (Path(source_dir) / name).is_file() or (Path(source_dir) / name).read_bytes() != data):
+                mismatches.append(name)
+
+        return mismatches
+
+
+class PackedDataset:
+    """Packed dataset root, organized like the processed dataset with one shard per camera directory"""
+
+    def __init__(self, packed_dir, cache_chunks=4, prefetch=True):
+        """
+        Parameters
+        ----------
+        packed_dir : Path, str
+            output directory of pack_dataset
+        cache_chunks : int, optional
+            number of chunks kept in memory per shard, default: 4
+        prefetch : bool, optional
+            read the next chunk in the background, default: True
+        """
+
+        self.packed_dir = Path(packed_dir)
+        self.cache_chunks = cache_chunks
+        self.prefetch = prefetch
+        self.shards = dict()
+        self.lock = threading.Lock()
+
+    def shard(self, subject, pose, cam, image_dir="images_processed"):
+        """Returns the PackedShard of a camera directory, e.g. shard("SUBJECT_C058", "POSE_00", "Cam01")"""
+
+        key = (subject, pose, image_dir, cam)
+        with self.lock:
+            if key not in self.shards.keys():
+                self.shards[key] = PackedShard(self.packed_dir.joinpath(*key[:3]) / f"{cam}{PACK_SUFFIX}", self.cache_chunks, self.prefetch)
+
+        return self.shards[key]
+
+    def frames(self, subject, pose, cam, image_dir="images_processed"):
+        """Returns the frames of a camera directory as PackedFrames, usable wherever a sorted list of image paths is expected"""
+        return self.shard(subject, pose, cam, image_dir).frames()
+
+
+def index_path(pack_path):
+    pack_path = Path(pack_path)
+    return pack_path.with_name(pack_path.name[:-len(PACK_SUFFIX)] + INDEX_SUFFIX)
+
+
+def pack_camera(source_dir, pack_path, chunk_size=32, image_end=".avif"):
+    """ Packs the images of a camera directory into a shard. Shards whose index exists are complete and skipped.
+
+    Parameters
+    ----------
+    source_dir : Path, str
+        camera directory, e.g. SUBJECT/POSE/images_processed/CamXX
+    pack_path : Path, str
+        path of the shard to write, e.g. OUT/SUBJECT/POSE/images_processed/CamXX.pack
+    chunk_size : int, optional
+        number of frames read at once by PackedShard, default: 32
+    image_end : str, optional
+        type of images to pack, default: ".avif"
+
+    Returns
+    -------
+    n_frames : int
+        number of packed frames, 0 if the shard already existed
+    """
+
+    pack_path = Path(pack_path)
+    if index_path(pack_path).is_file():
+        return 0
+
+    image_paths = sorted(Path(source_dir).glob(f"*{image_end}"))
+    pack_path.parent.mkdir(parents=True, exist_ok=True)
+
+    offsets = np.zeros(len(image_paths) + 1, dtype=np.int64)
+    crc32 = np.zeros(len(image_paths), dtype=np.uint32)
+
+    # Write to temporary files first, the index is moved into place last and marks the shard as complete
+    tmp_pack = pack_path.with_name(pack_path.name + ".tmp")
+    with open(str(tmp_pack), "wb") as file:
+        for idx, image_path in enumerate(image_paths):
+            data = image_path.read_bytes()
+            file.write(data)
+            offsets[idx + 1] = offsets[idx] + len(data)
+            crc32[idx] = zlib.crc32(data)
+
+    tmp_index = pack_path.with_name(pack_path.name + ".index.tmp")
+    with open(str(tmp_index), "wb") as file:
+        np.savez(file, names=np.array([p.name for p in image_paths]), offsets=offsets, crc32=crc32, chunk_size=np.int64(chunk_size))
+
+    os.replace(tmp_pack, pack_path)
+    os.replace(tmp_index, index_path(pack_path))
+
+    return len(image_paths)
+
+
+def find_camera_dirs(dataset_dir, subjects=None, poses=None, image_dir="images_processed"):
+    """Lists the (subject, pose, cam) camera directories of a dataset"""
+
+    dataset_dir = Path(dataset_dir)
+    units = []
+
+    for subject_dir in sorted(dataset_dir.glob("SUBJECT_*")):
+        if subjects is not None and subject_dir.name not in subjects:
+            continue
+        for pose_dir in sorted(subject_dir.glob("POSE_*")):
+            if poses is not None and pose_dir.name not in poses:
+                continue
+            for cam_dir in sorted((pose_dir / image_dir).glob("Cam*")):
+                units.append((subject_dir.name, pose_dir.name, cam_dir.name))
+
+    return units
+
+
+def pack_dataset(dataset_dir, packed_dir, subjects=None, poses=None, image_dir="images_processed", chunk_size=32, workers=8):
+    """ Packs the camera directories of a dataset into shards in parallel. Interrupted runs can be resumed,
+    complete shards are skipped.
+
+    Parameters
+    ----------
+    dataset_dir : Path, str
+        path to the dataset root
+    packed_dir : Path, str
+        output directory, organized like the dataset
+    subjects : list of str, optional
+        subjects to pack, default: None (all)
+    poses : list of str, optional
+        poses to pack, default: None (all)
+    image_dir : str, optional
+        name of the image directory, default: "images_processed"
+    chunk_size : int, optional
+        number of frames read at once by PackedShard, default: 32
+    workers : int, optional
+        number of camera directories packed in parallel, default: 8
+
+    Returns
+    -------
+    n_frames : int
+        number of newly packed frames
+    """
+
+    units = find_camera_dirs(dataset_dir, subjects, poses, image_dir)
+
+    def pack(unit):
+        subject, pose, cam = unit
+        return pack_camera(Path(dataset_dir) / subject / pose / image_dir / cam, Path(packed_dir) / subject / pose / image_dir / f"{cam}{PACK_SUFFIX}", chunk_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(tqdm(pool.map(pack, units), total=len(units)))
+
+
+def verify_packed_dataset(dataset_dir, packed_dir, subjects=None, poses=None, image_dir="images_processed", workers=8):
+    """ Verifies the shards of a packed dataset byte by byte against the source images
+
+    Parameters
+    ----------
+    dataset_dir : Path, str
+        path to the dataset root
+    packed_dir : Path, str
+        output directory of pack_dataset
+    subjects : list of str, optional
+        subjects to verify, default: None (all)
+    poses : list of str, optional
+        poses to verify, default: None (all)
+    image_dir : str, optional
+        name of the image directory, default: "images_processed"
+    workers : int, optional
+        number of camera directories verified in parallel, default: 8
+
+    Returns
+    -------
+    errors : list of str
+        description of every missing shard, missing or extra frame and mismatching frame
+    """
+
+    units = find_camera_dirs(dataset_dir, subjects, poses, image_dir)
+    packed = PackedDataset(packed_dir, prefetch=False)
+
+    def verify(unit):
+        subject, pose, cam = unit
+        source_dir = Path(dataset_dir) / subject / pose / image_dir / cam
+
+        try:
+            shard = packed.shard(subject, pose, cam, image_dir)
+        except FileNotFoundError:
+            return [f"{'/'.join(unit)}: shard missing"]
+
+        errors = []
+        source_names = [p.name for p in sorted(source_dir.glob("*.avif"))]
+        if source_names != shard.names:
+            errors.append(f"{'/'.join(unit)}: frame lists differ ({len(source_names)} source, {len(shard.names)} packed)")
+        errors += [f"{'/'.join(unit)}/{name}: content differs" for name in shard.verify(source_dir)]
+
+        return errors
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [error for errors in tqdm(pool.map(verify, units), total=len(units)) for error in errors]
@@ -9,12 +9,13 @@ import pyrender
 
 from visualize.pyrender_olat_scene import PyRenderOLATScene
 from utils.avif_image_utils import load_image_np
+from utils.metadata_readers import olat_frames
 
 
 class ImageSequence:
     """Represents a sequence of images found in a particular directory."""
 
-    def __init__(self, sequence_id, image_path_dir, image_end=".avif"):
+    def __init__(self, sequence_id, image_path_dir, image_end=".avif", downscale=None, target_size=None, image_paths=None):
         """
         Parameters
         ----------
@@ -24,11 +25,21 @@ class ImageSequence:
             Path to the directory containing the sequence
         image_end : str, optional
             Type of images in directory (default is ".avif")
+        downscale : int, optional
+            Load images at 1 / downscale of their resolution (default is None, full resolution)
+        target_size : int, tuple, optional
+            Load images with this size of the longer side or as (W, H) (default is None, full resolution)
+        image_paths : list, optional
+            Sorted images of the sequence, e.g. PackedDataset.frames(...) of a packed dataset (default is None, find images in image_path_dir)
         """
 
         self.sequence_id = sequence_id
+        self.downscale = downscale
+        self.target_size = target_size
         self.image_path_dir = Path(image_path_dir)
-        self.image_paths = list(sorted(self.image_path_dir.glob(f'*{image_end}')))[:361] # Find images in dir
+        if image_paths is None:
+            image_paths = sorted(self.image_path_dir.glob(f'*{image_end}')) # Find images in dir
+        self.image_paths = list(image_paths)[:361]
 
         print(f"[DEBUG] Initialized ImageSequence: {sequence_id}, Found {len(self.image_paths)} images in {image_path_dir}")
 
@@ -43,7 +54,7 @@ class ImageSequence:
             raise IndexError("Image index out of range")
 
         print(f"[DEBUG] Loading image {idx} from sequence {self.sequence_id}")
-        img_np = load_image_np(str(self.image_paths[idx]))
+        img_np = load_image_np(self.image_paths[idx], downscale=self.downscale, target_size=self.target_size)
 
         return img_np
 
@@ -67,6 +78,7 @@ class Take:
         # Optional rendering for mesh
         self.pyrender_scene = None
         self.renderer = None
+        self.light_rig = None
 
     def add_cameras(self, sequences):
         self.sequences.extend(sequences)
@@ -117,6 +129,7 @@ class Take:
 
         self.pyrender_scene = PyRenderOLATScene(W, H, mesh_path, texture_path, calib_folder, lights_pos_path, lights_seq_path)
         self.renderer = pyrender.offscreen.OffscreenRenderer(W, H)
+        self.light_rig = self.pyrender_scene.light_rig
 
         print(f"[DEBUG] Added pyrender scene to Take {self.take_id}")
 
@@ -124,8 +137,16 @@ class Take:
 class OLATExplorer:
     """ Adds a pyrender scene for mesh rendering to this capture"""
 
-    def __init__(self):
+    def __init__(self, display_downscale=2):
+        """
+        Parameters
+        ----------
+        display_downscale : int, optional
+            Factor to scale displayed images down by, use 1 if the ImageSequences are already loaded at reduced resolution (default is 2)
+        """
+
         self.takes = []
+        self.display_downscale = display_downscale
 
         self.number_cams = None
         self.number_frames = None
@@ -152,17 +173,15 @@ class OLATExplorer:
             self.number_cams = len(take.sequences)
             self.number_frames = len(take.sequences[0]) if take.sequences else 0
 
-            OLAT_FB_FRAMES = [14, 34, 55, 76, 97, 118, 139, 160, 181, 202, 223, 244, 265, 286, 307, 328, 349]
-            self.frame_to_light = [] # -1 fullbright, other is single light
-
-            count = 0
-            for frame in range(self.number_frames):
-                if frame <= OLAT_FB_FRAMES[0] or frame in OLAT_FB_FRAMES or count >= 331:
-                    self.frame_to_light.append(-1)
-                    continue
-                
-                self.frame_to_light.append(count)
-                count += 1
+            # -1 fullbright, other is single light
+            if take.light_rig is not None:
+                self.frame_to_light = take.light_rig.frame_to_light(self.number_frames)
+            else:
+                # Default capture layout of 331 lights
+                light_frame = olat_frames(331, OLAT_START=14, OLAT_FB_MODULO=21)
+                light_frame = light_frame[light_frame < self.number_frames]
+                self.frame_to_light = np.full(self.number_frames, -1, dtype=np.int64)
+                self.frame_to_light[light_frame] = np.arange(len(light_frame))
         
         assert len(take) == self.number_cams, "Number of sequences in take does not match the expected number of cameras."
         for sequence in take.sequences:
@@ -208,9 +227,11 @@ class OLATExplorer:
    
             image = self.takes[self.take_idx][self.seq_idx][self.img_idx]
             
-            # Scale the image down by half
+            # Scale the image down for display
             height, width = image.shape[:2]
-            image = cv2.resize(image, (width // 2, height // 2), interpolation=cv2.INTER_AREA)
+            display_size = (width // self.display_downscale, height // self.display_downscale)
+            if self.display_downscale > 1:
+                image = cv2.resize(image, display_size, interpolation=cv2.INTER_AREA)
 
 
             # Also render mesh if enabled
@@ -226,7 +247,8 @@ class OLATExplorer:
                 assert mesh_img is not None, "Unable to render mesh"
                 mesh_height, mesh_width = mesh_img.shape[:2]
                 assert mesh_width == width and mesh_height == height, "Rendered mesh does not match image size"
-                mesh_img = cv2.resize(mesh_img, (width // 2, height // 2), interpolation=cv2.INTER_AREA)
+                if self.display_downscale > 1:
+                    mesh_img = cv2.resize(mesh_img, display_size, interpolation=cv2.INTER_AREA)
 
                 if self.mesh_image_overlap == 0: # Do nothing
                     pass
@@ -4,7 +4,7 @@ import math
 from pathlib import Path
 
 from pathlib import Path
-from utils.metadata_readers import read_calib, read_OLAT_info
+from utils.metadata_readers import load_camera_rig, load_light_rig
 import cv2 as cv
 import numpy as np
 
@@ -63,11 +63,12 @@ class PyRenderOLATScene:
         self.mesh_obj['mesh_node'] = self.scene.add(self.mesh_obj['mesh'])
 
     def load_camera(self, calib_folder):
-        self.INTR, self.EXTR, self.DISTOR, self.focal_length = [], [], [], []
-        read_calib(str(calib_folder), self.W, self.INTR, self.EXTR,  DISTOR=self.DISTOR, focal_length=self.focal_length, invert_extr=False)
+        self.rig = load_camera_rig(calib_folder, self.W) # Shared with other users of the same calib file
+        self.INTR, self.EXTR, self.DISTOR, self.focal_length = self.rig.intrinsics, self.rig.c2w, self.rig.distortion, self.rig.focal_length
 
     def load_light_info(self, lights_pos_path, lights_seq_path):
-        self.light_positions, self.light_img = read_OLAT_info(lights_pos_path, lights_seq_path, 14, 21, exclude_door_lights=False)
+        self.light_rig = load_light_rig(lights_pos_path, lights_seq_path, 14, 21) # Shared with other users of the same light files
+        self.light_positions, self.light_img = self.light_rig.positions, self.light_rig.light_frame
         self.ls_approximate_center = np.mean(self.light_positions, axis=0)
 
         self.light_spheres_node = None # self.add_light_spheres(range(len(self.light_positions)))
@@ -95,7 +96,7 @@ class PyRenderOLATScene:
         fx, fy, cx, cy = self.INTR[new_cam_idx][0, 0], self.INTR[new_cam_idx][1, 1], self.INTR[new_cam_idx][0, 2], self.INTR[new_cam_idx][1, 2]
 
         # Extrinsic parameters (pose)
-        extr = np.linalg.inv(np.copy(self.EXTR[new_cam_idx]))
+        extr = self.rig.w2c[new_cam_idx].copy()
         extr[:3, 1:3] *= -1
 
         # Create final camera